@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.core import checks
 
 
 class AuthenticationConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'authentication'
+
+    def ready(self):
+        from .conf import check_auth_client
+        checks.register(check_auth_client)
+        # Registers the token cache invalidation signal handlers.
+        from . import authentication  # noqa: F401
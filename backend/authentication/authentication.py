@@ -0,0 +1,116 @@
+"""
+Cached OAuth2 access-token validation.
+
+oauth2_provider looks up the AccessToken and its user on every request.
+Valid tokens are kept here in a per-process LRU. The key is the token
+checksum, and each entry lives for AUTH_TOKEN_CACHE_TTL seconds or until
+the token expires, whichever comes first. A warm request costs no queries.
+
+Deleting or changing an AccessToken drops it from this process's cache.
+That covers logout (revocation deletes the token), refresh and cleartokens.
+Other processes notice within the TTL.
+"""
+import copy
+import hashlib
+
+from django.conf import settings
+from django.contrib.auth import authenticate
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from oauth2_provider.contrib.rest_framework import OAuth2Authentication
+from oauth2_provider.models import get_access_token_model
+from oauth2_provider.utils import parse_bearer_token
+
+from chatbot.cache import BoundedCache
+
+AccessToken = get_access_token_model()
+
+_cache = BoundedCache(settings.AUTH_TOKEN_CACHE_SIZE, settings.AUTH_TOKEN_CACHE_TTL)
+
+
+def token_checksum(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def get_access_token(token):
+    """
+    Returns the valid AccessToken (with its user) for a raw token string, or None.
+    None is also returned for tokens this cache does not handle (resource-
+    restricted ones); callers fall back to oauth2_provider's own validation.
+    """
+    checksum = token_checksum(token)
+    access_token = _cache.get(checksum)
+    if access_token is None:
+        access_token = (
+            AccessToken.objects.select_related('application', 'user')
+            .filter(token_checksum=checksum)
+            .first()
+        )
+        if access_token is None or getattr(access_token, 'resource', None):
+            return None
+        ttl = min(settings.AUTH_TOKEN_CACHE_TTL, (access_token.expires - timezone.now()).total_seconds())
+        if ttl <= 0 or not access_token.is_valid():
+            return None
+        _cache.set(checksum, access_token, ttl=ttl)
+    elif access_token.is_expired():
+        _cache.delete(checksum)
+        return None
+
+    # Each request gets its own instances; the cached ones are shared between threads.
+    request_token = copy.copy(access_token)
+    request_token.user = copy.copy(access_token.user)
+    return request_token
+
+
+def invalidate(checksum):
+    _cache.delete(checksum)
+
+
+def cache_stats():
+    return _cache.stats()
+
+
+@receiver(post_save, sender=AccessToken)
+@receiver(post_delete, sender=AccessToken)
+def access_token_changed(sender, instance, **kwargs):
+    invalidate(instance.token_checksum)
+
+
+class CachedOAuth2Authentication(OAuth2Authentication):
+    """DRF authentication that answers from the token cache when it can."""
+
+    def authenticate(self, request):
+        if request is None:
+            return None
+        token = parse_bearer_token(request.META.get('HTTP_AUTHORIZATION', ''))
+        access_token = get_access_token(token) if token else None
+        if access_token is None:
+            # Missing, invalid or uncacheable: let oauth2_provider produce the
+            # result and the WWW-Authenticate error details.
+            return super().authenticate(request)
+        return access_token.user, access_token
+
+
+class CachedOAuth2TokenMiddleware:
+    """
+    Drop-in for oauth2_provider.middleware.OAuth2TokenMiddleware that resolves
+    Bearer tokens through the same cache, so the middleware and DRF don't
+    each look the token up.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = parse_bearer_token(request.META.get('HTTP_AUTHORIZATION', ''))
+        if token and (not hasattr(request, 'user') or request.user.is_anonymous):
+            access_token = get_access_token(token)
+            user = access_token.user if access_token else authenticate(request=request)
+            if user:
+                request.user = request._cached_user = user
+
+        response = self.get_response(request)
+        patch_vary_headers(response, ('Authorization',))
+        return response
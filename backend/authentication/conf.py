@@ -0,0 +1,75 @@
+"""
+OAuth2 client configuration for the login, refresh and logout views.
+
+The values come from the environment (ID, SECRET and BASE_URL, usually set
+in backend/.env). They are read and checked once, when settings load, and
+are exposed as ``settings.AUTH_CLIENT``. Request handlers only read that
+attribute. Call reload() after changing the environment or .env.
+"""
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.core import checks
+from django.core.exceptions import ImproperlyConfigured
+
+ENV_FILE = Path(__file__).resolve().parent.parent / '.env'
+
+
+@dataclass(frozen=True)
+class AuthClientConfig:
+    client_id: str | None = None
+    client_secret: str | None = field(default=None, repr=False)
+    base_url: str | None = None
+
+    def __post_init__(self):
+        if self.base_url:
+            parsed = urlparse(self.base_url)
+            if parsed.scheme not in ('http', 'https') or not parsed.netloc:
+                raise ImproperlyConfigured(f"BASE_URL must be an http(s) URL, got {self.base_url!r}.")
+
+    @property
+    def is_configured(self):
+        return bool(self.client_id and self.client_secret)
+
+    @classmethod
+    def from_env(cls, environ=None):
+        environ = os.environ if environ is None else environ
+
+        def value(name):
+            return (environ.get(name) or '').strip() or None
+
+        base_url = value('BASE_URL')
+        return cls(
+            client_id=value('ID'),
+            client_secret=value('SECRET'),
+            base_url=base_url.rstrip('/') if base_url else None,
+        )
+
+
+def reload(env_file=ENV_FILE):
+    """Re-reads the .env file and environment and replaces settings.AUTH_CLIENT."""
+    from dotenv import load_dotenv
+
+    load_dotenv(env_file, override=True)
+    settings.AUTH_CLIENT = AuthClientConfig.from_env()
+    return settings.AUTH_CLIENT
+
+
+def check_auth_client(app_configs, **kwargs):
+    """System check run at startup: token views cannot work without client credentials."""
+    config = getattr(settings, 'AUTH_CLIENT', None)
+    if not isinstance(config, AuthClientConfig):
+        return [checks.Error(
+            "settings.AUTH_CLIENT must be an authentication.conf.AuthClientConfig.",
+            id='authentication.E001',
+        )]
+    if not config.is_configured:
+        return [checks.Warning(
+            "OAuth2 client credentials are not set; login, refresh and logout will fail.",
+            hint="Set ID and SECRET in the environment or backend/.env.",
+            id='authentication.W001',
+        )]
+    return []
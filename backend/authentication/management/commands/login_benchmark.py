@@ -0,0 +1,168 @@
+import os
+import statistics
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from django.contrib.auth import authenticate, get_user_model
+from django.core.management.base import BaseCommand
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.core.wsgi import get_wsgi_application
+from django.db import connection
+from django.test import RequestFactory, override_settings
+from oauth2_provider.models import Application
+
+from authentication.conf import ENV_FILE, AuthClientConfig
+from authentication.tokens import issue_token
+
+User = get_user_model()
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares login throughput when tokens are issued in-process (authentication.tokens) "
+        "with the old HTTP loopback to /oauth/token/. Each login runs the LoginView steps on "
+        "a pool of --workers threads standing in for server workers. Loopback logins call "
+        "a live server started in this process, or --base-url if given. Also times reading the "
+        "client config per request from .env against settings.AUTH_CLIENT. Creates its own "
+        "throwaway user and OAuth2 application and deletes them afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--logins', type=int, default=200, help='Logins per mode (default: 200).')
+        parser.add_argument('--workers', type=int, default=8, help='Concurrent logins (default: 8).')
+        parser.add_argument('--mode', choices=['both', 'in-process', 'loopback'], default='both')
+        parser.add_argument('--base-url', help='Server to use for loopback logins instead of a built-in one.')
+        parser.add_argument('--fast-hasher', action='store_true',
+                            help='Hash the bench password with MD5 so token issuing, not hashing, dominates.')
+
+    def handle(self, *args, **options):
+        run_id = uuid.uuid4().hex[:8]
+        hashers = ['django.contrib.auth.hashers.MD5PasswordHasher'] if options['fast_hasher'] else settings.PASSWORD_HASHERS
+
+        config_costs = self.time_config(options['logins'])
+        with override_settings(PASSWORD_HASHERS=hashers):
+            credentials = self.setup(run_id)
+            server = None
+            try:
+                base_url = options['base_url']
+                if options['mode'] != 'in-process' and not base_url:
+                    server, base_url = self.start_server()
+                modes = ['loopback', 'in-process'] if options['mode'] == 'both' else [options['mode']]
+                with override_settings(AUTH_CLIENT=AuthClientConfig(
+                    client_id=credentials['client_id'], client_secret=credentials['client_secret'],
+                )):
+                    results = {mode: self.run(mode, credentials, base_url, options) for mode in modes}
+            finally:
+                if server is not None:
+                    server.shutdown()
+                    server.server_close()
+                Application.objects.filter(name=f'bench-{run_id}').delete()
+                User.objects.filter(username=f'bench-{run_id}').delete()
+        self.report(results, config_costs)
+
+    def time_config(self, iterations):
+        """Seconds per request spent getting the client config, before and after."""
+        import dotenv
+
+        started = time.perf_counter()
+        for _ in range(iterations):
+            # What every token view used to do.
+            dotenv.load_dotenv(dotenv_path=ENV_FILE)
+            os.getenv("ID"), os.getenv("SECRET"), os.getenv("BASE_URL")
+        per_request_env = (time.perf_counter() - started) / iterations
+
+        started = time.perf_counter()
+        for _ in range(iterations):
+            client = settings.AUTH_CLIENT
+            client.client_id, client.client_secret, client.base_url
+        per_request_settings = (time.perf_counter() - started) / iterations
+        return {'.env per request': per_request_env, 'settings.AUTH_CLIENT': per_request_settings}
+
+    def setup(self, run_id):
+        email = f'bench-{run_id}@bench.invalid'
+        password = uuid.uuid4().hex
+        user = User.objects.create_user(
+            username=f'bench-{run_id}', email=email, password=password, first_name='Bench', last_name='Login'
+        )
+        secret = uuid.uuid4().hex
+        application = Application.objects.create(
+            name=f'bench-{run_id}', user=user, client_type=Application.CLIENT_CONFIDENTIAL,
+            authorization_grant_type=Application.GRANT_PASSWORD, client_secret=secret,
+        )
+        return {'username': getattr(user, User.USERNAME_FIELD), 'password': password,
+                'client_id': application.client_id, 'client_secret': secret}
+
+    def start_server(self):
+        server = ThreadedWSGIServer(('127.0.0.1', 0), QuietHandler)
+        server.set_app(get_wsgi_application())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, f'http://127.0.0.1:{server.server_port}'
+
+    def run(self, mode, credentials, base_url, options):
+        factory = RequestFactory()
+        session = requests.Session()
+
+        def login(_):
+            try:
+                started = time.perf_counter()
+                user = authenticate(username=credentials['username'], password=credentials['password'])
+                if user is None:
+                    return None
+                if mode == 'loopback':
+                    # What LoginView used to do: a second HTTP request to this server.
+                    response = session.post(
+                        f'{base_url}/oauth/token/',
+                        data={'grant_type': 'password', 'username': credentials['username'],
+                              'password': credentials['password']},
+                        auth=(credentials['client_id'], credentials['client_secret']),
+                    )
+                    ok = response.status_code == 200
+                else:
+                    status_code, _ = issue_token(factory.post('/api/auth/login/'),
+                                                 credentials['username'], credentials['password'])
+                    ok = status_code == 200
+                return time.perf_counter() - started if ok else None
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            outcomes = list(pool.map(login, range(options['logins'])))
+        elapsed = time.perf_counter() - started
+        latencies = sorted(outcome for outcome in outcomes if outcome is not None)
+        return {'elapsed': elapsed, 'latencies': latencies, 'failed': len(outcomes) - len(latencies)}
+
+    def report(self, results, config_costs):
+        for source, seconds in config_costs.items():
+            self.stdout.write(f"Client config from {source}: {seconds * 1e6:.2f} µs per request")
+        for mode, result in results.items():
+            latencies = result['latencies']
+
+            def percentile(p):
+                if not latencies:
+                    return float('nan')
+                return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+            self.stdout.write(
+                f"{mode}: {len(latencies)} logins in {result['elapsed']:.2f}s "
+                f"({len(latencies) / result['elapsed']:.1f} logins/s), "
+                f"p50 {percentile(0.50):.1f} ms, p99 {percentile(0.99):.1f} ms"
+                + (f", mean {statistics.fmean(latencies) * 1000:.1f} ms" if latencies else '')
+            )
+            if result['failed']:
+                self.stdout.write(self.style.WARNING(f"{mode}: {result['failed']} logins failed."))
+        if len(results) == 2 and all(result['latencies'] for result in results.values()):
+            speedup = (
+                (len(results['in-process']['latencies']) / results['in-process']['elapsed'])
+                / (len(results['loopback']['latencies']) / results['loopback']['elapsed'])
+            )
+            self.stdout.write(f"In-process throughput: {speedup:.2f}x loopback")
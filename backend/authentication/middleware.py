@@ -0,0 +1,37 @@
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.contrib.auth.models import AnonymousUser
+from oauth2_provider.settings import oauth2_settings
+from oauthlib.common import Request as OAuthRequest
+
+from .authentication import get_access_token
+
+
+@database_sync_to_async
+def get_token_user(token):
+    """Returns the user owning a valid OAuth2 access token, or AnonymousUser."""
+    access_token = get_access_token(token)
+    if access_token is not None:
+        return access_token.user
+    validator = oauth2_settings.OAUTH2_VALIDATOR_CLASS()
+    request = OAuthRequest('')
+    if validator.validate_bearer_token(token, [], request):
+        return request.user
+    return AnonymousUser()
+
+
+class OAuth2TokenAuthMiddleware(BaseMiddleware):
+    """
+    Authenticates WebSocket connections with an OAuth2 access token.
+    Browsers can't set an Authorization header on a WebSocket handshake, so the
+    token is passed as ``?access_token=...`` and resolved to scope['user'].
+    """
+
+    async def __call__(self, scope, receive, send):
+        query = parse_qs(scope.get('query_string', b'').decode())
+        token = query.get('access_token', [None])[0]
+        if token:
+            scope['user'] = await get_token_user(token)
+        return await super().__call__(scope, receive, send)
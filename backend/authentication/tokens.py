@@ -0,0 +1,66 @@
+"""
+Token issue, refresh and revocation without an HTTP round trip.
+
+The login, refresh and logout views used to call our own /oauth/token/ and
+/oauth/revoke_token/ endpoints through BASE_URL. Every one of those requests
+tied up a second worker on the same server. Here the oauth2_provider views
+are called directly with a request built in-process. The grant handling,
+token storage and the app_authorized signal are unchanged.
+"""
+import json
+
+from django.conf import settings
+from django.http import HttpRequest, QueryDict
+from django.urls import reverse
+from oauth2_provider.views import RevokeTokenView, TokenView
+
+_token_view = TokenView.as_view()
+_revoke_view = RevokeTokenView.as_view()
+
+# Client details that are safe to pass on to the token endpoint. The caller's
+# Authorization header and body are deliberately not copied.
+FORWARDED_META = ('REMOTE_ADDR', 'SERVER_NAME', 'SERVER_PORT', 'HTTP_HOST', 'HTTP_USER_AGENT', 'HTTP_X_FORWARDED_FOR')
+
+
+def _call(view, url_name, request, data):
+    client = settings.AUTH_CLIENT
+    if not client.is_configured:
+        return 500, {'error': 'OAuth2 application not configured'}
+
+    oauth_request = HttpRequest()
+    oauth_request.method = 'POST'
+    oauth_request.path = oauth_request.path_info = reverse(url_name)
+    oauth_request.META = {key: request.META[key] for key in FORWARDED_META if key in request.META}
+    oauth_request.META['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+    oauth_request.POST = QueryDict(mutable=True)
+    oauth_request.POST.update({
+        'client_id': client.client_id,
+        'client_secret': client.client_secret,
+        **data,
+    })
+
+    response = view(oauth_request)
+    body = json.loads(response.content) if response.content else {}
+    return response.status_code, body
+
+
+def issue_token(request, username, password):
+    """Password grant. Returns (status_code, token response body)."""
+    return _call(_token_view, 'oauth2_provider:token', request, {
+        'grant_type': 'password',
+        'username': username,
+        'password': password,
+    })
+
+
+def refresh_token(request, refresh_token):
+    """Refresh token grant. Returns (status_code, token response body)."""
+    return _call(_token_view, 'oauth2_provider:token', request, {
+        'grant_type': 'refresh_token',
+        'refresh_token': refresh_token,
+    })
+
+
+def revoke_token(request, token):
+    """Revokes an access or refresh token. Returns (status_code, response body)."""
+    return _call(_revoke_view, 'oauth2_provider:revoke-token', request, {'token': token})
@@ -1,7 +1,18 @@
 from django.contrib import admin
-from .models import ChatRoom, Message, EncryptionRecord
+from .models import ArchivedMessage, ChatRoom, Message, EncryptionRecord, KeyRotationCheckpoint, ReadCursor
 
 # Register your models here.
 admin.site.register(ChatRoom)
-admin.site.register(Message)
+admin.site.register(ArchivedMessage)
 admin.site.register(EncryptionRecord)
+admin.site.register(KeyRotationCheckpoint)
+admin.site.register(ReadCursor)
+
+
+@admin.register(Message)
+class MessageAdmin(admin.ModelAdmin):
+    # `content` is empty unless CHAT_STORE_PLAINTEXT is on, and the form would save
+    # that empty value as the new text, overwriting the ciphertext. It is shown
+    # decrypted and read-only instead.
+    exclude = ['content']
+    readonly_fields = ['decrypted_content', 'encrypted_text']
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        # Registers the membership cache invalidation and read cursor signal handlers.
+        from . import membership, receipts  # noqa: F401
@@ -0,0 +1,199 @@
+"""
+Archival tier for old messages.
+
+Messages older than their room's retention age (ChatRoom.archive_after_days,
+or CHAT_ARCHIVE_AFTER_DAYS) are moved from Message to ArchivedMessage by the
+archive_messages command, one short transaction per batch. The hot table
+then only holds recent history, so it and its indexes stay small enough to
+be served from memory. The EncryptionRecord rows of archived legacy
+messages are deleted in the same move.
+
+History reads cover both tables through History, which behaves like a
+queryset for the few operations the message views use. Each read runs on
+the hot table first. The archive is only queried when the read can reach
+back past ChatRoom.archived_through.
+"""
+import base64
+import heapq
+from datetime import timedelta
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .encryption import encrypt_bytes
+from .models import ArchivedMessage, ChatRoom, EncryptionRecord, Message
+
+
+def retention_days(room):
+    """Days a room's messages stay in the hot table; None if they are never archived."""
+    if room.archive_after_days is not None:
+        return room.archive_after_days
+    return settings.CHAT_ARCHIVE_AFTER_DAYS
+
+
+def archive_room(room, cutoff, batch_size=1000):
+    """
+    Moves one batch of `room`'s messages older than `cutoff`, oldest first,
+    into ArchivedMessage. Returns the number of messages moved; 0 once
+    nothing older than the cutoff is left.
+    """
+    with transaction.atomic():
+        batch = list(
+            Message.objects.select_for_update()
+            .filter(room=room, timestamp__lt=cutoff)
+            .only('id', 'room_id', 'user_id', 'content', 'timestamp', 'edited', 'edited_at',
+                  'ciphertext', 'encrypted_text_id')
+            .order_by('timestamp', 'id')[:batch_size]
+        )
+        if not batch:
+            return 0
+
+        records = EncryptionRecord.objects.in_bulk(
+            {m.encrypted_text_id for m in batch if m.ciphertext is None and m.encrypted_text_id}
+        )
+        archived = []
+        for message in batch:
+            if message.ciphertext is not None:
+                ciphertext = message.ciphertext
+            elif message.encrypted_text_id in records:
+                ciphertext = base64.urlsafe_b64decode(records[message.encrypted_text_id].encrypted_text)
+            elif message.content is not None:
+                # Rows from before encryption was added only have plaintext.
+                ciphertext = encrypt_bytes(message.content)
+            else:
+                ciphertext = b''
+            archived.append(ArchivedMessage(
+                id=message.id, room_id=message.room_id, user_id=message.user_id, timestamp=message.timestamp,
+                edited=message.edited, edited_at=message.edited_at, ciphertext=ciphertext,
+            ))
+        ArchivedMessage.objects.bulk_create(archived)
+        Message.objects.filter(id__in=[message.id for message in batch]).delete()
+        EncryptionRecord.objects.filter(pk__in=list(records)).delete()
+
+        # Rows are moved in timestamp order, so the last one is the newest archived so far.
+        newest = batch[-1].timestamp
+        if room.archived_through is None or newest > room.archived_through:
+            room.archived_through = newest
+            ChatRoom.objects.filter(pk=room.pk).update(archived_through=newest)
+    return len(batch)
+
+
+def rooms_due(now=None):
+    """Yields (room, cutoff) for every room with archiving enabled."""
+    now = now or timezone.now()
+    for room in ChatRoom.objects.order_by('pk'):
+        days = retention_days(room)
+        if days is not None:
+            yield room, now - timedelta(days=days)
+
+
+class History:
+    """
+    A room's messages across Message and ArchivedMessage, read like one
+    queryset. filter(), select_related() and order_by() apply to both
+    tables. count() adds them up. Slicing reads the same slice from each
+    table and merges them in order.
+
+    Ordering must be on model fields, all in the same direction, ending in
+    a unique one (e.g. ('-timestamp', '-id')), since rows are merged by
+    comparing those values.
+    """
+
+    def __init__(self, room, hot, archived, ordering=()):
+        self.room = room
+        self.hot = hot
+        self.archived = archived
+        self.ordering = ordering
+
+    @classmethod
+    def for_room(cls, room):
+        return cls(room, Message.objects.filter(room=room), ArchivedMessage.objects.filter(room=room))
+
+    def _clone(self, hot=None, archived=None, ordering=None):
+        return History(
+            self.room,
+            self.hot if hot is None else hot,
+            self.archived if archived is None else archived,
+            self.ordering if ordering is None else ordering,
+        )
+
+    def filter(self, *args, **kwargs):
+        return self._clone(self.hot.filter(*args, **kwargs), self.archived.filter(*args, **kwargs))
+
+    def select_related(self, *fields):
+        return self._clone(self.hot.select_related(*fields), self.archived.select_related(*fields))
+
+    def order_by(self, *fields):
+        return self._clone(ordering=fields)
+
+    @property
+    def ordered(self):
+        return bool(self.ordering)
+
+    @property
+    def has_archive(self):
+        return self.room.archived_through is not None
+
+    def count(self):
+        return self.hot.count() + (self.archived.count() if self.has_archive else 0)
+
+    def _key(self, row):
+        return tuple(getattr(row, field.lstrip('-')) for field in self.ordering)
+
+    def _reaches_archive(self, hot_rows, limit):
+        """
+        Whether the archive can hold rows among the first `limit`. For newest-first
+        reads it cannot once `limit` hot rows all come after archived_through.
+        """
+        if not self.has_archive:
+            return False
+        if self.ordering[0] != '-timestamp' or len(hot_rows) < limit:
+            return True
+        return hot_rows[-1].timestamp <= self.room.archived_through
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice) or index.stop is None or index.step is not None:
+            raise TypeError("History only supports slices with a stop, e.g. [:25] or [50:75].")
+        if not self.ordering:
+            raise TypeError("History must be ordered before it is sliced.")
+        start, stop = index.start or 0, index.stop
+        hot = self.hot.order_by(*self.ordering)
+        archived = self.archived.order_by(*self.ordering)
+        if not self.has_archive:
+            return list(hot[start:stop])
+
+        if start == 0:
+            # A single page (keyset pagination, sync): merge the rows directly.
+            hot_rows = list(hot[:stop])
+            archived_rows = list(archived[:stop]) if self._reaches_archive(hot_rows, stop) else []
+            merged = heapq.merge(hot_rows, archived_rows, key=self._key, reverse=self._descending)
+            return list(islice(merged, stop))
+
+        if self.ordering[0] == '-timestamp':
+            # A page whose last hot row is newer than everything archived is all hot.
+            last = hot.values_list('timestamp', flat=True)[stop - 1:stop]
+            if last and last[0] > self.room.archived_through:
+                return list(hot[start:stop])
+
+        # Deep page-number reads that reach the archive merge only the ordering
+        # values, then load the page's rows.
+        fields = [field.lstrip('-') for field in self.ordering]
+        hot_keys = [('hot', *values) for values in hot.values_list(*fields, 'pk')[:stop]]
+        archived_keys = [('archived', *values) for values in archived.values_list(*fields, 'pk')[:stop]]
+        page = list(islice(
+            heapq.merge(hot_keys, archived_keys, key=lambda k: k[1:-1], reverse=self._descending),
+            start, stop,
+        ))
+        hot_ids = [k[-1] for k in page if k[0] == 'hot']
+        archived_ids = [k[-1] for k in page if k[0] == 'archived']
+        rows = {
+            **(self.hot.in_bulk(hot_ids) if hot_ids else {}),
+            **(self.archived.in_bulk(archived_ids) if archived_ids else {}),
+        }
+        return [rows[k[-1]] for k in page if k[-1] in rows]
+
+    @property
+    def _descending(self):
+        return self.ordering[0].startswith('-')
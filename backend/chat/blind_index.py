@@ -0,0 +1,62 @@
+"""
+Blind index for keyword search over encrypted messages.
+
+Each message's text is split into normalised words, and every word is
+replaced by a keyed HMAC truncated to 64 bits. Only these values are stored
+(see MessageSearchToken), so the database never holds plaintext. Without
+the key, the stored values only show which messages share a word, not what
+the word is. A search blinds its query terms the same way and looks them
+up in the postings table.
+
+The key comes from CHAT_SEARCH_KEY. If it is unset, messages are not
+indexed and search is unavailable. Changing the key invalidates the whole
+index; run `index_messages --rebuild` afterwards.
+"""
+import hashlib
+import hmac
+import re
+import unicodedata
+
+from django.conf import settings
+
+WORD_RE = re.compile(r'\w+')
+MIN_WORD_LENGTH = 2
+MAX_WORD_LENGTH = 64
+# Very long messages only index their first distinct words.
+MAX_TOKENS_PER_MESSAGE = 500
+
+_key = settings.CHAT_SEARCH_KEY.encode() if settings.CHAT_SEARCH_KEY else None
+
+
+def is_enabled():
+    return _key is not None
+
+
+def words(text):
+    """Distinct normalised words in `text`, in order of first appearance."""
+    normalised = unicodedata.normalize('NFKC', text or '').casefold()
+    seen = {}
+    for word in WORD_RE.findall(normalised):
+        if MIN_WORD_LENGTH <= len(word) <= MAX_WORD_LENGTH:
+            seen.setdefault(word, None)
+            if len(seen) == MAX_TOKENS_PER_MESSAGE:
+                break
+    return list(seen)
+
+
+def blind(word):
+    """Keyed 64-bit digest of one normalised word, as a signed integer for a BigIntegerField."""
+    digest = hmac.new(_key, word.encode(), hashlib.sha256).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+def blind_words(text):
+    """Blinded tokens for every distinct word in `text`; empty when search is disabled."""
+    if _key is None:
+        return []
+    return [blind(word) for word in words(text)]
+
+
+def matches_query(query, text):
+    """Whether `text` contains every word of `query`; used to drop digest collisions."""
+    return set(words(query)) <= set(words(text))
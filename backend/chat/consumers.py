@@ -0,0 +1,204 @@
+import asyncio
+from collections import deque
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
+
+from . import membership, presence, receipts, recent
+from .fanout import broadcaster, room_group_name
+from .monitoring import MONITORING_GROUP, feed
+from .models import ChatRoom, Message
+from .serializers import MessageCreateSerializer, MessageSerializer
+from .throttling import send_limiter
+
+
+class ChatConsumer(AsyncJsonWebsocketConsumer):
+    """
+    WebSocket endpoint for a single room: ws/chat/<slug>/
+
+    Client -> server:
+        {"type": "message", "content": "..."}
+        {"type": "heartbeat"}                            keeps the user online (see chat.presence)
+        {"type": "typing", "is_typing": true|false}      debounced, never stored (see chat.receipts)
+        {"type": "read", "message_id": <id>}             moves the user's read cursor (never past the newest message)
+    Server -> client:
+        {"type": "message", "message": {...}}            a single event
+        {"type": "typing", "user": {...}, "is_typing": true|false}
+        {"type": "receipts", "receipts": [{"user_id": <id>, "last_read_message_id": <id>}, ...]}
+        {"type": "batch", "events": [{...}, {...}]}      several coalesced events
+        {"type": "error", "error": "..."}
+        {"type": "error", "error": "...", "code": 429, "retry_after": <seconds>}   send rate exceeded
+    The socket is closed with code 4403 once the user leaves the room.
+    """
+
+    async def connect(self):
+        self.user = self.scope.get('user')
+        if self.user is None or not self.user.is_authenticated:
+            await self.close(code=4401)
+            return
+
+        self.room = await self.get_room(self.scope['url_route']['kwargs']['slug'])
+        if self.room is None:
+            await self.close(code=4404)
+            return
+        if not await database_sync_to_async(membership.is_member)(self.room.pk, self.user.pk):
+            await self.close(code=4403)
+            return
+
+        self.group_name = room_group_name(self.room.pk)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+        presence.tracker.connect(self.user.pk)
+        presence.tracker.ensure_flush_task()
+        receipts.read_cursors.ensure_flush_task()
+
+    async def disconnect(self, code):
+        if hasattr(self, 'group_name'):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+            presence.tracker.disconnect(self.user.pk)
+            await self.publish_typing(False)
+
+    async def receive_json(self, content, **kwargs):
+        event_type = content.get('type') if isinstance(content, dict) else None
+        if event_type == 'heartbeat':
+            presence.tracker.heartbeat(self.user.pk)
+            return
+        # The user may have left since connecting, possibly through another process.
+        if not await database_sync_to_async(membership.is_member)(self.room.pk, self.user.pk):
+            await self.leave_room()
+            return
+        if event_type == 'typing':
+            await self.publish_typing(bool(content.get('is_typing', True)))
+            return
+        if event_type == 'read':
+            message_id = content.get('message_id')
+            if type(message_id) is not int or message_id < 1:
+                await self.send_json({'type': 'error', 'error': 'message_id must be a positive integer.'})
+                return
+            receipts.read_cursors.mark_read(self.user.pk, self.room.pk, message_id)
+            return
+        if event_type != 'message':
+            await self.send_json({'type': 'error', 'error': 'Unsupported event type.'})
+            return
+        presence.tracker.heartbeat(self.user.pk)
+
+        serializer = MessageCreateSerializer(data={'content': content.get('content')})
+        if not serializer.is_valid():
+            await self.send_json({'type': 'error', 'error': serializer.errors})
+            return
+        # With shared buckets this is a Redis round trip, so it stays off the event loop.
+        wait = await sync_to_async(send_limiter.check)(self.user.pk, self.room.pk)
+        if wait:
+            await self.send_json({
+                'type': 'error', 'error': 'Rate limit exceeded.', 'code': 429, 'retry_after': round(wait, 2),
+            })
+            return
+
+        message, ciphertext = await self.create_message(serializer.validated_data['content'])
+        await broadcaster.publish(
+            self.channel_layer, self.group_name, {'type': 'message', 'message': message}
+        )
+        feed.record(self.room.pk, message['id'], ciphertext)
+        # Sending a message ends the sender's typing indicator. Message.save() has
+        # already moved their read cursor up to it.
+        await self.publish_typing(False)
+
+    async def publish_typing(self, is_typing):
+        if not receipts.typing.should_send(self.room.pk, self.user.pk, is_typing):
+            return
+        await broadcaster.publish(self.channel_layer, self.group_name, {
+            'type': 'typing',
+            'user': {'id': self.user.pk, 'username': self.user.username},
+            'is_typing': is_typing,
+        })
+
+    async def chat_batch(self, event):
+        """Delivers a group message from RoomBroadcaster as one WebSocket frame."""
+        events = event['events']
+        if len(events) == 1:
+            await self.send_json(events[0])
+        else:
+            await self.send_json({'type': 'batch', 'events': events})
+
+    async def chat_members_removed(self, event):
+        """Closes this socket if its user was removed from the room."""
+        if event['user_ids'] is None or self.user.pk in event['user_ids']:
+            await self.leave_room()
+
+    async def leave_room(self):
+        # Stop delivery before closing, so nothing more reaches this socket.
+        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        await self.close(code=4403)
+
+    @database_sync_to_async
+    def get_room(self, slug):
+        return ChatRoom.objects.filter(slug=slug).first()
+
+    @database_sync_to_async
+    def create_message(self, content):
+        # Message.save() encrypts and does the blocking DB write, so it runs
+        # in the thread pool rather than on the event loop.
+        message = Message.objects.create(room=self.room, user=self.user, content=content)
+        # The plaintext is already at hand; don't decrypt what was just encrypted.
+        message._decrypted_content = content
+        data = dict(MessageSerializer(message).data)
+        recent.messages.append(self.room.slug, message, data)
+        return data, message.ciphertext
+
+
+class MonitoringConsumer(AsyncJsonWebsocketConsumer):
+    """
+    WebSocket endpoint for the monitoring dashboard: ws/monitoring/ (staff only).
+
+    Events from the monitoring feed are never sent from the group handlers.
+    They go into a bounded per-connection queue that drops the oldest entry
+    when full. A writer task sends whatever is queued as one frame every
+    CHAT_MONITORING_FLUSH_INTERVAL seconds. A slow dashboard therefore only
+    loses events and never holds up the channel layer or chat delivery.
+
+    Server -> client:
+        {"type": "batch", "events": [...], "dropped": <events lost since the last frame>}
+    where events are `new_encrypted_message` samples and `room_throughput` stats.
+    """
+
+    async def connect(self):
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated or not user.is_staff:
+            await self.close(code=4403)
+            return
+
+        self.queue = deque(maxlen=settings.CHAT_MONITORING_QUEUE_SIZE)
+        self.dropped = 0
+        await self.channel_layer.group_add(MONITORING_GROUP, self.channel_name)
+        await self.accept()
+        feed.ensure_stats_task()
+        self.writer = asyncio.create_task(self.write_loop())
+
+    async def disconnect(self, code):
+        if hasattr(self, 'writer'):
+            self.writer.cancel()
+            await self.channel_layer.group_discard(MONITORING_GROUP, self.channel_name)
+
+    def enqueue(self, event):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(event)
+
+    async def monitor_event(self, event):
+        self.enqueue(event['event'])
+
+    async def monitor_stats(self, event):
+        self.enqueue(event['stats'])
+
+    async def write_loop(self):
+        interval = settings.CHAT_MONITORING_FLUSH_INTERVAL
+        while True:
+            await asyncio.sleep(interval)
+            if not self.queue:
+                continue
+            events = list(self.queue)
+            self.queue.clear()
+            dropped, self.dropped = self.dropped, 0
+            await self.send_json({'type': 'batch', 'events': events, 'dropped': dropped})
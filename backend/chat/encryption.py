@@ -0,0 +1,249 @@
+import base64
+import logging
+import os
+import sys
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from django.conf import settings
+from dotenv import load_dotenv
+
+from chatbot.cache import BoundedCache
+
+logger = logging.getLogger(__name__)
+
+# --- Securely load and validate the encryption keys ---
+# FERNET_KEYS is a comma-separated keyring, newest key first. New data is always
+# encrypted with the first key; every key in the ring can decrypt. A single
+# FERNET_KEY is still accepted for deployments that have never rotated.
+load_dotenv()
+fernet_keys = [key.strip() for key in os.getenv('FERNET_KEYS', '').split(',') if key.strip()]
+if not fernet_keys and os.getenv('FERNET_KEY'):
+    fernet_keys = [os.getenv('FERNET_KEY')]
+
+# Initialize fernet instance to None initially
+fernet = None
+
+if not fernet_keys:
+    # Fail loudly at startup if the key is missing. This is a critical configuration error.
+    logger.critical("CRITICAL: FERNET_KEYS/FERNET_KEY not found in environment variables. Application cannot start.")
+    # In a real app, this might prevent the server from starting.
+    # For now, we raise an exception.
+    raise ValueError("FERNET_KEY is not set. Please check your .env file or environment variables.")
+else:
+    try:
+        # The keys must be bytes. Fernet will validate their format (URL-safe base64-encoded 32-bytes).
+        fernet = MultiFernet([Fernet(key.encode()) for key in fernet_keys])
+    except (ValueError, TypeError) as e:
+        logger.critical(f"CRITICAL: One of the provided FERNET_KEYS is invalid. Error: {e}")
+        raise ValueError(f"The FERNET_KEY is invalid and cannot be used for encryption. Error: {e}")
+
+
+NO_CONTENT = "[No Content]"
+DECRYPTION_FAILED_INVALID_TOKEN = "[DECRYPTION FAILED: Invalid Token]"
+DECRYPTION_FAILED_UNEXPECTED = "[DECRYPTION FAILED: Unexpected Error]"
+# What decrypt_text() returns instead of a message's text.
+PLACEHOLDERS = frozenset({NO_CONTENT, DECRYPTION_FAILED_INVALID_TOKEN, DECRYPTION_FAILED_UNEXPECTED})
+
+# Shared pool for large batches. Created lazily so processes that never
+# render big history pages don't pay for idle threads.
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.CHAT_DECRYPT_MAX_WORKERS,
+            thread_name_prefix='chat-decrypt',
+        )
+    return _executor
+
+
+def encrypt_bytes(plaintext):
+    """
+    Encrypts a string and returns the raw Fernet token bytes.
+    Fernet tokens are base64url text; storing the decoded bytes in a binary
+    column saves a quarter of the space.
+    """
+    return base64.urlsafe_b64decode(fernet.encrypt(plaintext.encode()))
+
+
+def encrypt_many(plaintexts):
+    """
+    Encrypts a list of strings and returns their raw token bytes in the same order.
+    Large batches are spread over the shared pool, as in decrypt_many().
+    """
+    plaintexts = list(plaintexts)
+    workers = settings.CHAT_DECRYPT_MAX_WORKERS
+    if not workers or len(plaintexts) < settings.CHAT_DECRYPT_PARALLEL_THRESHOLD:
+        return [encrypt_bytes(text) for text in plaintexts]
+
+    chunk_size = -(-len(plaintexts) // workers)
+    chunks = [plaintexts[i:i + chunk_size] for i in range(0, len(plaintexts), chunk_size)]
+    results = []
+    for encrypted in _get_executor().map(lambda chunk: [encrypt_bytes(text) for text in chunk], chunks):
+        results.extend(encrypted)
+    return results
+
+
+def rotate_bytes(ciphertext):
+    """
+    Re-encrypts stored ciphertext under the primary (first) key.
+    Accepts anything to_token() does and returns raw token bytes.
+    Raises InvalidToken if no key in the ring can decrypt it.
+    """
+    return base64.urlsafe_b64decode(fernet.rotate(to_token(ciphertext)))
+
+
+def to_token(ciphertext):
+    """
+    Normalises stored ciphertext into a Fernet token.
+    Accepts raw bytes from Message.ciphertext (bytes or memoryview, depending on
+    the database driver) and legacy base64 text from EncryptionRecord.
+    """
+    if isinstance(ciphertext, str):
+        return ciphertext.encode()
+    return base64.urlsafe_b64encode(bytes(ciphertext))
+
+
+def _decrypt(token, message_id):
+    try:
+        return fernet.decrypt(to_token(token)).decode()
+    except InvalidToken:
+        # This is the specific exception for failed decryption.
+        # It could mean the data is corrupt or the encryption key has changed.
+        logger.error(
+            f"DECRYPTION FAILED for Message ID {message_id}. "
+            "The token is invalid. This may be due to data corruption or a key change."
+        )
+        return DECRYPTION_FAILED_INVALID_TOKEN
+    except Exception as e:
+        # Catch any other unexpected errors during decryption.
+        logger.error(f"An unexpected error occurred during decryption for Message ID {message_id}: {e}")
+        return DECRYPTION_FAILED_UNEXPECTED
+
+
+# --- Decryption cache ---
+# Plaintext of recently read messages, keyed by message id and bounded by
+# CHAT_DECRYPT_CACHE_BYTES. Each entry keeps the token it was decrypted from
+# and only counts as a hit for that same token, so a message edited or
+# re-encrypted by another process is decrypted again instead of served stale.
+# Failed decryptions are never cached.
+
+def _entry_size(entry):
+    token, plaintext = entry
+    return sys.getsizeof(token) + sys.getsizeof(plaintext) + 64  # + key and bookkeeping
+
+
+_cache = BoundedCache(
+    maxsize=None,
+    ttl=settings.CHAT_DECRYPT_CACHE_TTL,
+    maxbytes=settings.CHAT_DECRYPT_CACHE_BYTES,
+    sizeof=_entry_size,
+)
+_cache_lock = threading.Lock()
+_cache_counters = Counter()
+
+
+def _cached(message_id, token):
+    entry = _cache.get(message_id)
+    if entry is not None and entry[0] == token:
+        return entry[1]
+    return None
+
+
+def remember(message_id, token, plaintext):
+    """Caches a message's plaintext, e.g. right after encrypting it, so nobody has to decrypt it."""
+    if plaintext not in PLACEHOLDERS:
+        # memoryviews from the database driver would pin the whole result buffer.
+        _cache.set(message_id, (bytes(token) if isinstance(token, memoryview) else token, plaintext))
+
+
+def _count(hits, misses):
+    with _cache_lock:
+        _cache_counters['hits'] += hits
+        _cache_counters['misses'] += misses
+
+
+def cache_stats():
+    stats = _cache.stats()
+    # A stale entry is a hit for the LRU but a miss for callers, so report ours.
+    with _cache_lock:
+        stats['hits'] = _cache_counters['hits']
+        stats['misses'] = _cache_counters['misses']
+    return stats
+
+
+def decrypt_text(token, message_id=None, use_cache=True):
+    """
+    Decrypts a single Fernet token and returns the plaintext.
+    Failures are logged and turned into placeholder strings so one bad row
+    never breaks a whole history response.
+    When message_id is given, the decryption cache is checked first and
+    updated afterwards.
+    """
+    if not token:
+        logger.warning(f"Message {message_id} has no associated encrypted text to decrypt.")
+        return NO_CONTENT
+
+    use_cache = use_cache and message_id is not None and settings.CHAT_DECRYPT_CACHE_BYTES
+    if use_cache:
+        plaintext = _cached(message_id, token)
+        _count(plaintext is not None, plaintext is None)
+        if plaintext is not None:
+            return plaintext
+
+    plaintext = _decrypt(token, message_id)
+    if use_cache:
+        remember(message_id, token, plaintext)
+    return plaintext
+
+
+def _decrypt_chunk(items):
+    return [(message_id, decrypt_text(token, message_id, use_cache=False)) for message_id, token in items]
+
+
+def decrypt_many(tokens, use_cache=True):
+    """
+    Decrypts a mapping of {message_id: token} and returns {message_id: plaintext}.
+
+    Messages in the decryption cache are answered from it. Of the rest, small
+    batches are decrypted inline. When CHAT_DECRYPT_MAX_WORKERS is set and
+    the batch reaches CHAT_DECRYPT_PARALLEL_THRESHOLD, the work is split into
+    one chunk per worker and run on a shared thread pool.
+    Pass use_cache=False for one-off scans (exports, reindexing) so they
+    neither read nor evict the cache.
+    """
+    results = {}
+    items = list(tokens.items())
+    use_cache = use_cache and settings.CHAT_DECRYPT_CACHE_BYTES
+    if use_cache:
+        missing = []
+        for message_id, token in items:
+            plaintext = _cached(message_id, token) if token else None
+            if plaintext is None:
+                missing.append((message_id, token))
+            else:
+                results[message_id] = plaintext
+        _count(len(results), len(missing))
+        items = missing
+
+    workers = settings.CHAT_DECRYPT_MAX_WORKERS
+    if not workers or len(items) < settings.CHAT_DECRYPT_PARALLEL_THRESHOLD:
+        decrypted = dict(_decrypt_chunk(items))
+    else:
+        chunk_size = -(-len(items) // workers)
+        chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+        decrypted = {}
+        for chunk in _get_executor().map(_decrypt_chunk, chunks):
+            decrypted.update(chunk)
+
+    if use_cache:
+        for message_id, token in items:
+            if token:
+                remember(message_id, token, decrypted[message_id])
+    results.update(decrypted)
+    return results
@@ -0,0 +1,111 @@
+"""
+Outgoing event fan-out for chat rooms.
+
+Every event for a room goes to the room's channel group. In a busy room,
+sending each message as its own group message means every member receives
+a stream of tiny frames. RoomBroadcaster coalesces them: a quiet room gets
+each event immediately; once a room has sent something within the last
+CHAT_FANOUT_WINDOW seconds, further events are buffered and delivered
+together at the end of the window (or as soon as CHAT_FANOUT_MAX_BATCH are
+waiting). Consumers receive a `chat.batch` group message either way.
+"""
+import asyncio
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def room_group_name(room_id):
+    return f'chat_{room_id}'
+
+
+class RoomBroadcaster:
+    def __init__(self, window=None, max_batch=None):
+        self.window = settings.CHAT_FANOUT_WINDOW if window is None else window
+        self.max_batch = settings.CHAT_FANOUT_MAX_BATCH if max_batch is None else max_batch
+        self._buffers = {}
+        self._flush_handles = {}
+        self._last_sent = {}
+
+    async def publish(self, channel_layer, group, event):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        last_sent = self._last_sent.get(group)
+        buffer = self._buffers.get(group)
+
+        if buffer is None and (last_sent is None or now - last_sent >= self.window):
+            # Quiet room: deliver straight away.
+            self._sent(loop, group, now)
+            await channel_layer.group_send(group, {'type': 'chat.batch', 'events': [event]})
+            return
+
+        if buffer is None:
+            buffer = self._buffers[group] = []
+            delay = max(0.0, self.window - (now - last_sent))
+            self._flush_handles[group] = loop.call_later(
+                delay, lambda: asyncio.ensure_future(self.flush(channel_layer, group))
+            )
+        buffer.append(event)
+        if len(buffer) >= self.max_batch:
+            await self.flush(channel_layer, group)
+
+    async def flush(self, channel_layer, group):
+        handle = self._flush_handles.pop(group, None)
+        if handle is not None:
+            handle.cancel()
+        events = self._buffers.pop(group, None)
+        if not events:
+            return
+        loop = asyncio.get_running_loop()
+        self._sent(loop, group, loop.time())
+        await channel_layer.group_send(group, {'type': 'chat.batch', 'events': events})
+
+    def _sent(self, loop, group, now):
+        self._last_sent[group] = now
+        # Once a window has passed the entry no longer delays anything, so it is
+        # dropped and rooms that go quiet leave nothing behind.
+        loop.call_later(self.window, self._forget, group, now)
+
+    def _forget(self, group, sent_at):
+        if self._last_sent.get(group) == sent_at and group not in self._buffers:
+            del self._last_sent[group]
+
+
+# One broadcaster per process; consumers share it so batching spans all senders here.
+broadcaster = RoomBroadcaster()
+
+
+def broadcast_event(room_id, event):
+    """
+    Sends one event to a room's group from synchronous code (e.g. REST views).
+    Delivery is best effort: a channel layer outage must not fail the request
+    that already saved the message.
+    """
+    broadcast_events(room_id, [event])
+
+
+def broadcast_events(room_id, events):
+    """Like broadcast_event(), for several events delivered as one frame."""
+    _group_send(room_id, {'type': 'chat.batch', 'events': events})
+
+
+def broadcast_members_removed(room_id, user_ids):
+    """
+    Tells the room's open sockets that these users are no longer members, so
+    their connections are closed. `user_ids` None means every member.
+    """
+    _group_send(room_id, {'type': 'chat.members_removed', 'user_ids': None if user_ids is None else list(user_ids)})
+
+
+def _group_send(room_id, message):
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    try:
+        async_to_sync(channel_layer.group_send)(room_group_name(room_id), message)
+    except Exception as e:
+        logger.error(f"Failed to broadcast event to room {room_id}: {e}")
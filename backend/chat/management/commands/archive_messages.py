@@ -0,0 +1,48 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.archive import archive_room, rooms_due
+from chat.models import ChatRoom
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves messages older than their room's retention age (ChatRoom.archive_after_days, "
+        "or CHAT_ARCHIVE_AFTER_DAYS) from the message table to the archive table. Each batch "
+        "is moved in its own short transaction, so the command can run on a live database, "
+        "e.g. nightly from cron, and be stopped and rerun at any time."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Messages moved per transaction (default: 1000).')
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='Seconds to pause between batches to limit load (default: 0).')
+        parser.add_argument('--room', help='Only archive the room with this slug.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        pause = options['sleep']
+
+        rooms = rooms_due()
+        if options['room']:
+            if not ChatRoom.objects.filter(slug=options['room']).exists():
+                raise CommandError(f'No room with slug "{options["room"]}".')
+            rooms = ((room, cutoff) for room, cutoff in rooms if room.slug == options['room'])
+
+        started = time.monotonic()
+        total = 0
+        for room, cutoff in rooms:
+            moved = 0
+            while batch := archive_room(room, cutoff, batch_size):
+                moved += batch
+                if pause:
+                    time.sleep(pause)
+            if moved:
+                self.stdout.write(f"{room.slug}: archived {moved} messages older than {cutoff:%Y-%m-%d %H:%M}")
+            total += moved
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Done: {total} messages archived in {time.monotonic() - started:.1f}s."
+        ))
@@ -0,0 +1,204 @@
+import asyncio
+import statistics
+import time
+import tracemalloc
+import uuid
+from datetime import timedelta
+
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from oauth2_provider.models import AccessToken
+
+from chat.models import ChatRoom, Message
+from chat.throttling import send_limiter
+
+User = get_user_model()
+
+# Send rate used for both limiters during a run: high enough that no sender is ever throttled.
+UNLIMITED = 10 ** 9
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-tests WebSocket fan-out in-process. Starts N simulated clients spread over M rooms "
+        "against the ASGI application, has one client per room send messages, and reports "
+        "throughput, delivery latency and memory per connection. Creates its own throwaway "
+        "users, rooms and tokens and deletes them afterwards. Send rate limits are lifted in "
+        "this process for the run, since they would otherwise cap every sender at its burst. "
+        "Run with CHANNEL_LAYER=memory to benchmark without Redis."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=200, help='Total simulated clients (default: 200).')
+        parser.add_argument('--rooms', type=int, default=10, help='Rooms to spread clients over (default: 10).')
+        parser.add_argument('--messages', type=int, default=20, help='Messages sent per room (default: 20).')
+        parser.add_argument('--interval', type=float, default=0.0,
+                            help='Seconds between sends from each room sender (default: 0).')
+        parser.add_argument('--timeout', type=float, default=60.0,
+                            help='Give up waiting for deliveries after this many seconds (default: 60).')
+
+    def handle(self, *args, **options):
+        clients = options['clients']
+        rooms = min(options['rooms'], clients)
+        run_id = uuid.uuid4().hex[:8]
+
+        self.stdout.write(
+            f"Channel layer: {settings.CHANNEL_LAYERS['default']['BACKEND']}\n"
+            f"Setting up {clients} clients in {rooms} rooms..."
+        )
+        room_objs, tokens = self.setup(run_id, clients, rooms)
+        limits = [(buckets, buckets.rate, buckets.burst) for buckets in (send_limiter.users, send_limiter.rooms)]
+        try:
+            for buckets, _, _ in limits:
+                buckets.rate = buckets.burst = UNLIMITED
+            results = asyncio.run(self.run(room_objs, tokens, options))
+            results.update(self.persisted(room_objs, results['started_at']))
+        finally:
+            for buckets, rate, burst in limits:
+                buckets.rate, buckets.burst = rate, burst
+            User.objects.filter(username__startswith=f'bench-{run_id}-').delete()
+        self.report(results)
+
+    def setup(self, run_id, clients, rooms):
+        users = User.objects.bulk_create([
+            User(username=f'bench-{run_id}-{i}', email=f'bench-{run_id}-{i}@bench.invalid',
+                 first_name='Bench', last_name=str(i))
+            for i in range(clients)
+        ])
+        room_objs = ChatRoom.objects.bulk_create([
+            ChatRoom(name=f'Bench {run_id} {r}', slug=f'bench-{run_id}-{r}', created_by=users[r],
+                     max_members=clients)
+            for r in range(rooms)
+        ])
+        Membership = ChatRoom.members.through
+        Membership.objects.bulk_create([
+            Membership(chatroom_id=room_objs[i % rooms].pk, user_id=user.pk) for i, user in enumerate(users)
+        ])
+        expires = timezone.now() + timedelta(hours=1)
+        AccessToken.objects.bulk_create([
+            AccessToken(user=user, token=f'bench-{run_id}-{uuid.uuid4().hex}', expires=expires, scope='read write')
+            for user in users
+        ])
+        tokens = [
+            (room_objs[i % rooms], token)
+            for i, token in enumerate(
+                AccessToken.objects.filter(user__in=users).order_by('user_id').values_list('token', flat=True)
+            )
+        ]
+        return room_objs, tokens
+
+    def persisted(self, room_objs, started):
+        """Messages written to the benchmark rooms, and seconds from the start until the last one was."""
+        timestamps = Message.objects.filter(room__in=room_objs).values_list('timestamp', flat=True)
+        newest = timestamps.order_by('-timestamp').first()
+        return {
+            'persisted': timestamps.count(),
+            'persist_seconds': (newest - started).total_seconds() if newest else 0.0,
+        }
+
+    async def run(self, room_objs, tokens, options):
+        from chatbot.asgi import application
+
+        messages = options['messages']
+        headers = [(b'origin', f'http://{settings.ALLOWED_HOSTS[0]}'.encode())]
+
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        connections = []
+        for room, token in tokens:
+            communicator = WebsocketCommunicator(
+                application, f'/ws/chat/{room.slug}/?access_token={token}', headers=headers
+            )
+            connected, code = await communicator.connect()
+            if not connected:
+                raise RuntimeError(f'Client for room {room.slug} was rejected with code {code}.')
+            connections.append((room, communicator))
+        memory_per_connection = (tracemalloc.get_traced_memory()[0] - baseline) / len(connections)
+        tracemalloc.stop()
+
+        sent_at = {}
+        latencies = []
+        senders = {}
+        members = {}
+        for room, communicator in connections:
+            senders.setdefault(room.pk, communicator)
+            members[room.pk] = members.get(room.pk, 0) + 1
+        expected = sum(members.values()) * messages
+
+        async def send_all(room_id, communicator):
+            for seq in range(messages):
+                content = f'bench:{room_id}:{seq}'
+                sent_at[content] = time.perf_counter()
+                await communicator.send_json_to({'type': 'message', 'content': content})
+                if options['interval']:
+                    await asyncio.sleep(options['interval'])
+
+        async def receive_all(communicator):
+            received = 0
+            while received < messages:
+                frame = await communicator.receive_json_from(timeout=options['timeout'])
+                now = time.perf_counter()
+                events = frame['events'] if frame.get('type') == 'batch' else [frame]
+                for event in events:
+                    if event.get('type') != 'message':
+                        continue
+                    content = event['message']['content']
+                    if content in sent_at:
+                        latencies.append(now - sent_at[content])
+                        received += 1
+
+        started = time.perf_counter()
+        started_at = timezone.now()
+        receivers = [asyncio.create_task(receive_all(communicator)) for _, communicator in connections]
+        await asyncio.gather(*(send_all(room_id, communicator) for room_id, communicator in senders.items()))
+        timed_out = False
+        try:
+            await asyncio.wait_for(asyncio.gather(*receivers), timeout=options['timeout'])
+        except (asyncio.TimeoutError, AssertionError):
+            timed_out = True
+        finished = time.perf_counter()
+
+        for _, communicator in connections:
+            try:
+                await communicator.disconnect()
+            except Exception:
+                # Timed-out communicators have already been torn down.
+                pass
+
+        return {
+            'clients': len(connections),
+            'rooms': len(senders),
+            'sent': len(sent_at),
+            'expected': expected,
+            'started_at': started_at,
+            'delivered': len(latencies),
+            'total_seconds': finished - started,
+            'latencies': sorted(latencies),
+            'memory_per_connection': memory_per_connection,
+            'timed_out': timed_out,
+        }
+
+    def report(self, results):
+        latencies = results['latencies']
+
+        def percentile(p):
+            if not latencies:
+                return float('nan')
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+        self.stdout.write(
+            f"Clients: {results['clients']} in {results['rooms']} rooms\n"
+            f"Messages sent: {results['sent']}, persisted: {results['persisted']}"
+            + (f" ({results['persisted'] / results['persist_seconds']:.1f} msg/s)" if results['persist_seconds'] else '')
+            + "\n"
+            f"Deliveries: {results['delivered']}/{results['expected']} "
+            f"({results['delivered'] / results['total_seconds']:.1f} deliveries/s)\n"
+            f"Latency p50: {percentile(0.50):.1f} ms, p99: {percentile(0.99):.1f} ms"
+            + (f", mean: {statistics.fmean(latencies) * 1000:.1f} ms" if latencies else '') + "\n"
+            f"Memory per connection: {results['memory_per_connection'] / 1024:.1f} KiB"
+        )
+        if results['timed_out']:
+            self.stdout.write(self.style.WARNING("Timed out before every delivery arrived."))
@@ -0,0 +1,138 @@
+import json
+import sys
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from chat.export import EXPORT_FORMAT_VERSION
+from chat.models import ChatRoom, Message
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports a room exported from GET /api/chat/rooms/<slug>/export/ (NDJSON). "
+        "The file is read as a stream and messages are re-encrypted with this deployment's "
+        "keys and written through Message.objects.bulk_send, one batch per transaction. "
+        "If the import fails, the partially imported room is deleted so it can be rerun."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Export file, or '-' to read from stdin.")
+        parser.add_argument('--slug', help='Slug for the new room (default: the exported slug).')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Messages inserted per batch (default: 5000).')
+        parser.add_argument('--create-users', action='store_true',
+                            help='Create inactive accounts, without a usable password, for unknown users.')
+
+    def handle(self, *args, **options):
+        stream = sys.stdin if options['path'] == '-' else open(options['path'], encoding='utf-8')
+        try:
+            self.import_stream(stream, options)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+    def import_stream(self, stream, options):
+        header = json.loads(stream.readline() or 'null')
+        if not isinstance(header, dict) or header.get('type') != 'room':
+            raise CommandError("The file does not start with a room header.")
+        if header.get('version') != EXPORT_FORMAT_VERSION:
+            raise CommandError(f"Unsupported export version {header.get('version')!r}.")
+
+        slug = options['slug'] or header['slug']
+        if ChatRoom.objects.filter(slug=slug).exists():
+            raise CommandError(f'A room with slug "{slug}" already exists; pass --slug to import under another.')
+        unknown = set(header['members']) - {user['email'] for user in header['users']}
+        if unknown:
+            raise CommandError(f"{len(unknown)} members are missing from the export's user list.")
+        if len(set(header['members'])) > header['max_members']:
+            raise CommandError(
+                f"The export lists {len(set(header['members']))} members but the room allows {header['max_members']}."
+            )
+
+        users = self.resolve_users(header['users'], options['create_users'])
+        room = ChatRoom.objects.create(
+            name=header['name'], slug=slug, description=header['description'],
+            is_private=header['is_private'], max_members=header['max_members'],
+            created_by_id=users[header['created_by']],
+        )
+        self.stdout.write(f'Importing into room "{room.name}" ({slug})...')
+        try:
+            self.import_messages(stream, room, users, header['members'], options)
+        except BaseException:
+            # Batches are committed as they go, so a failed import would leave a
+            # partial room behind and block a rerun under the same slug.
+            self.stderr.write(f'Import failed; deleting the partially imported room "{slug}".')
+            room.delete()
+            raise
+
+    def import_messages(self, stream, room, users, members, options):
+        started = time.monotonic()
+        imported = skipped = 0
+        batch = []
+        # The header was line 1.
+        for line_number, line in enumerate(stream, start=2):
+            if not line.strip():
+                continue
+            try:
+                data = json.loads(line)
+                if data.get('content') is None:
+                    skipped += 1
+                    continue
+                message = Message(
+                    room=room,
+                    user_id=users[data['user']],
+                    content=data['content'],
+                    timestamp=parse_datetime(data['timestamp']),
+                    edited=data['edited'],
+                    edited_at=parse_datetime(data['edited_at']) if data['edited_at'] else None,
+                )
+            except (ValueError, KeyError, TypeError) as e:
+                raise CommandError(f"Line {line_number} is not a valid message: {e!r}")
+            batch.append(message)
+            if len(batch) == options['batch_size']:
+                imported += len(Message.objects.bulk_send(batch))
+                batch = []
+                self.stdout.write(f"{imported} messages ({imported / (time.monotonic() - started):.0f}/s)")
+        imported += len(Message.objects.bulk_send(batch))
+
+        # Members are added last so their read cursors start at the newest imported message.
+        room.add_members(users[email] for email in members)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {imported} messages into {room.slug} in {time.monotonic() - started:.1f}s"
+            + (f"; skipped {skipped} that could not be decrypted at export." if skipped else ".")
+        ))
+
+    def resolve_users(self, exported, create):
+        """Maps exported emails to local user ids, creating accounts if asked to."""
+        by_email = {user['email']: user for user in exported}
+        users = dict(User.objects.filter(email__in=by_email).values_list('email', 'pk'))
+        missing = [by_email[email] for email in by_email if email not in users]
+        if missing and not create:
+            shown = ', '.join(user['email'] for user in missing[:10])
+            raise CommandError(
+                f"{len(missing)} users do not exist here ({shown}{', ...' if len(missing) > 10 else ''}). "
+                "Create them first or pass --create-users."
+            )
+
+        taken = set(User.objects.filter(username__in=[user['username'] for user in missing])
+                    .values_list('username', flat=True))
+        new_users = []
+        for user in missing:
+            username = user['username']
+            if username in taken:
+                username = user['email']
+            new_user = User(email=user['email'], username=username, first_name=user['first_name'],
+                            last_name=user['last_name'], is_active=False)
+            new_user.set_unusable_password()
+            new_users.append(new_user)
+        for user in User.objects.bulk_create(new_users):
+            users[user.email] = user.pk
+        if new_users:
+            self.stdout.write(f"Created {len(new_users)} inactive users.")
+        return users
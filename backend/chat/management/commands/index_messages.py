@@ -0,0 +1,65 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from chat import blind_index
+from chat.encryption import PLACEHOLDERS
+from chat.models import ArchivedMessage, Message, MessageSearchToken
+
+
+class Command(BaseCommand):
+    help = (
+        "Fills the blind search index for messages, archived ones included, that have no "
+        "search tokens yet. Works through each table in id order, decrypting and indexing "
+        "one batch per transaction, so it can run on a live database and be stopped and "
+        "rerun at any time."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Messages decrypted and indexed per batch (default: 1000).')
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='Seconds to pause between batches to limit load (default: 0).')
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Delete the whole index first, e.g. after changing CHAT_SEARCH_KEY.')
+
+    def handle(self, *args, **options):
+        if not blind_index.is_enabled():
+            raise CommandError("CHAT_SEARCH_KEY is not set; search indexing is disabled.")
+        batch_size = options['batch_size']
+        pause = options['sleep']
+
+        if options['rebuild']:
+            deleted, _ = MessageSearchToken.objects.all().delete()
+            self.stdout.write(f"Deleted {deleted} search tokens.")
+
+        indexed = skipped = 0
+        for model, fields in ((ArchivedMessage, ()), (Message, ('encrypted_text_id',))):
+            unindexed = (
+                model.objects.annotate(indexed=Exists(MessageSearchToken.objects.filter(message_id=OuterRef('pk'))))
+                .filter(indexed=False)
+                .only('id', 'room_id', 'ciphertext', *fields)
+                .order_by('id')
+            )
+            last_id = 0
+            while True:
+                batch = list(unindexed.filter(id__gt=last_id)[:batch_size])
+                if not batch:
+                    break
+                last_id = batch[-1].id
+
+                Message.prefetch_decrypted(batch, use_cache=False)
+                pairs = [(m, m.decrypted_content) for m in batch if m.decrypted_content not in PLACEHOLDERS]
+                skipped += len(batch) - len(pairs)
+                with transaction.atomic():
+                    MessageSearchToken.index(pairs)
+                indexed += len(pairs)
+                self.stdout.write(
+                    f"Indexed {model._meta.verbose_name}s up to {last_id} ({indexed} indexed, {skipped} skipped)"
+                )
+                if pause:
+                    time.sleep(pause)
+
+        self.stdout.write(self.style.SUCCESS(f"Done: {indexed} messages indexed, {skipped} skipped."))
@@ -0,0 +1,55 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from chat.models import Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Nulls out plaintext Message.content for messages that already have ciphertext. "
+        "Runs in small id-ordered batches so it can be used on a live database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Messages updated per batch (default: 5000).')
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='Seconds to pause between batches to limit load (default: 0).')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        pause = options['sleep']
+
+        # Very old rows may have plaintext and no ciphertext at all. Encrypt those
+        # first so nulling the plaintext never loses a message.
+        unencrypted = Message.objects.filter(
+            content__isnull=False, ciphertext__isnull=True, encrypted_text__isnull=True
+        )
+        encrypted_count = 0
+        for message in unencrypted.iterator(chunk_size=batch_size):
+            message.save(update_fields=['ciphertext', 'content'])
+            encrypted_count += 1
+        if encrypted_count:
+            self.stdout.write(f"Encrypted {encrypted_count} messages that had no ciphertext.")
+
+        has_ciphertext = Q(ciphertext__isnull=False) | Q(encrypted_text__isnull=False)
+        purged = 0
+        last_id = 0
+        while True:
+            ids = list(
+                Message.objects.filter(has_ciphertext, id__gt=last_id, content__isnull=False)
+                .order_by('id')
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+
+            purged += Message.objects.filter(id__in=ids).update(content=None)
+            last_id = ids[-1]
+            self.stdout.write(f"Purged plaintext from {purged} messages (up to id {last_id}).")
+            if pause:
+                time.sleep(pause)
+
+        self.stdout.write(self.style.SUCCESS(f"Done. Purged plaintext from {purged} messages."))
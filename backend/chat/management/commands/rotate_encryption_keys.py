@@ -0,0 +1,170 @@
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from cryptography.fernet import InvalidToken
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.db.models import Max, Min
+
+from chat.encryption import fernet, rotate_bytes
+from chat.models import ArchivedMessage, EncryptionRecord, KeyRotationCheckpoint, Message
+
+logger = logging.getLogger(__name__)
+
+# table name -> (model, field holding the ciphertext)
+# Stripes are fixed when a job starts, so messages archived while it runs can be
+# missed; pause archive_messages during a rotation.
+TABLES = {
+    'message': (Message, 'ciphertext'),
+    'archivedmessage': (ArchivedMessage, 'ciphertext'),
+    'encryptionrecord': (EncryptionRecord, 'encrypted_text'),
+}
+
+
+def rotate_value(table, value):
+    if table == 'encryptionrecord':
+        # Legacy rows keep their base64 text form.
+        return fernet.rotate(value.encode()).decode()
+    return rotate_bytes(value)
+
+
+def rotate_stripe(checkpoint_id, batch_size, pause):
+    """
+    Re-encrypts one stripe, batch by batch, committing the checkpoint with each batch.
+    Each batch locks only the rows it rewrites, so concurrent edits wait for
+    at most one short transaction and are never overwritten with stale ciphertext.
+    """
+    checkpoint = KeyRotationCheckpoint.objects.get(pk=checkpoint_id)
+    model, field = TABLES[checkpoint.table]
+
+    while checkpoint.last_id < checkpoint.end_id:
+        with transaction.atomic():
+            rows = list(
+                model.objects.select_for_update()
+                .filter(id__gt=checkpoint.last_id, id__lte=checkpoint.end_id, **{f'{field}__isnull': False})
+                .only('id', field)
+                .order_by('id')[:batch_size]
+            )
+            changed = []
+            for row in rows:
+                try:
+                    setattr(row, field, rotate_value(checkpoint.table, getattr(row, field)))
+                    changed.append(row)
+                except InvalidToken:
+                    checkpoint.failed += 1
+                    logger.error(f"Key rotation: {checkpoint.table} {row.id} cannot be decrypted with any key.")
+            if changed:
+                model.objects.bulk_update(changed, [field])
+
+            checkpoint.rotated += len(changed)
+            checkpoint.last_id = rows[-1].id if rows else checkpoint.end_id
+            checkpoint.finished = checkpoint.last_id >= checkpoint.end_id
+            checkpoint.save()
+
+        if pause and not checkpoint.finished:
+            time.sleep(pause)
+
+    return checkpoint.table, checkpoint.stripe, checkpoint.rotated, checkpoint.failed
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-encrypts all message ciphertext under the primary (first) key in FERNET_KEYS. "
+        "Work is split into id-range stripes processed in small throttled batches, optionally "
+        "across several worker processes. Progress is checkpointed in the database, so "
+        "re-running the command with the same --job resumes where it stopped. Once it "
+        "reports no failures, the old keys can be removed from FERNET_KEYS."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--job', default='default',
+                            help='Name of the rotation job; reuse it to resume (default: "default").')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Rows re-encrypted per transaction (default: 1000).')
+        parser.add_argument('--sleep', type=float, default=0.1,
+                            help='Seconds to pause between batches in each worker (default: 0.1).')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Worker processes, and stripes per table for a new job (default: 1).')
+        parser.add_argument('--restart', action='store_true',
+                            help='Discard the saved progress of this job and start over.')
+        parser.add_argument('--status', action='store_true',
+                            help='Only print the progress of this job.')
+
+    def handle(self, *args, **options):
+        job = options['job']
+        checkpoints = KeyRotationCheckpoint.objects.filter(job=job)
+
+        if options['status']:
+            self.print_status(checkpoints)
+            return
+        if options['restart']:
+            checkpoints.delete()
+        if not checkpoints.exists():
+            self.create_stripes(job, max(options['workers'], 1))
+
+        pending = list(checkpoints.filter(finished=False).values_list('pk', flat=True))
+        if not pending:
+            self.stdout.write(self.style.SUCCESS(f"Job '{job}' has nothing left to rotate."))
+            self.print_status(checkpoints)
+            return
+
+        workers = min(max(options['workers'], 1), len(pending))
+        self.stdout.write(f"Rotating {len(pending)} stripe(s) with {workers} worker(s)...")
+        args = (options['batch_size'], options['sleep'])
+
+        if workers == 1:
+            for checkpoint_id in pending:
+                self.report(rotate_stripe(checkpoint_id, *args))
+        else:
+            # Forked children must not share the parent's database connections.
+            connections.close_all()
+            context = multiprocessing.get_context('fork')
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+                futures = [executor.submit(rotate_stripe, checkpoint_id, *args) for checkpoint_id in pending]
+                for future in as_completed(futures):
+                    self.report(future.result())
+
+        self.print_status(checkpoints)
+
+    def create_stripes(self, job, stripes):
+        for table, (model, field) in TABLES.items():
+            bounds = model.objects.filter(**{f'{field}__isnull': False}).aggregate(low=Min('id'), high=Max('id'))
+            if bounds['low'] is None:
+                continue
+            # Rows added after this point are already written with the primary key.
+            span = bounds['high'] - bounds['low'] + 1
+            step = -(-span // stripes)
+            for stripe in range(stripes):
+                start = bounds['low'] + stripe * step
+                if start > bounds['high']:
+                    break
+                end = min(start + step - 1, bounds['high'])
+                KeyRotationCheckpoint.objects.create(
+                    job=job, table=table, stripe=stripe,
+                    start_id=start, end_id=end, last_id=start - 1,
+                )
+
+    def report(self, result):
+        table, stripe, rotated, failed = result
+        self.stdout.write(f"  {table} stripe {stripe}: {rotated} rotated, {failed} failed")
+
+    def print_status(self, checkpoints):
+        totals = {'rotated': 0, 'failed': 0, 'done': 0, 'stripes': 0}
+        for checkpoint in checkpoints.order_by('table', 'stripe'):
+            span = checkpoint.end_id - checkpoint.start_id + 1
+            progress = (checkpoint.last_id - checkpoint.start_id + 1) / span * 100
+            self.stdout.write(
+                f"  {checkpoint.table} stripe {checkpoint.stripe} [{checkpoint.start_id}..{checkpoint.end_id}]: "
+                f"{progress:.1f}% ({checkpoint.rotated} rotated, {checkpoint.failed} failed)"
+            )
+            totals['rotated'] += checkpoint.rotated
+            totals['failed'] += checkpoint.failed
+            totals['done'] += checkpoint.finished
+            totals['stripes'] += 1
+        style = self.style.SUCCESS if not totals['failed'] else self.style.WARNING
+        self.stdout.write(style(
+            f"{totals['done']}/{totals['stripes']} stripes finished, "
+            f"{totals['rotated']} rotated, {totals['failed']} failed."
+        ))
@@ -0,0 +1,65 @@
+"""
+Room membership checks.
+
+Membership is answered with an EXISTS query against the (chatroom, user)
+unique index of the members table and memoised per process for a few
+seconds. Joins and leaves made in this process invalidate the cached pair
+through the m2m_changed signal; other processes pick the change up when the
+TTL expires. A leave also tells the room's open WebSocket connections, in
+every process, to close the sockets of the users who left.
+"""
+from django.conf import settings
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
+
+from chatbot.cache import BoundedCache
+
+from .fanout import broadcast_members_removed
+from .models import ChatRoom
+
+Membership = ChatRoom.members.through
+
+_cache = BoundedCache(
+    maxsize=settings.CHAT_MEMBERSHIP_CACHE_SIZE,
+    ttl=settings.CHAT_MEMBERSHIP_CACHE_TTL,
+)
+
+
+def is_member(room_id, user_id):
+    """Returns True if the user belongs to the room."""
+    key = (room_id, user_id)
+    cached = _cache.get(key)
+    if cached is not None:
+        return cached
+
+    result = Membership.objects.filter(chatroom_id=room_id, user_id=user_id).exists()
+    _cache.set(key, result)
+    return result
+
+
+def invalidate(room_id, user_ids):
+    """Forgets the cached answers for these users in this room."""
+    for user_id in user_ids:
+        _cache.delete((room_id, user_id))
+
+
+@receiver(m2m_changed, sender=Membership)
+def members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    removed = action != 'post_add'
+    if action == 'post_clear' or pk_set is None:
+        # clear() doesn't report which pairs went away.
+        _cache.clear()
+        if removed and not reverse:
+            broadcast_members_removed(instance.pk, None)
+    elif reverse:
+        # user.chat_rooms.add(...): instance is the user, pk_set holds room ids.
+        for room_id in pk_set:
+            invalidate(room_id, [instance.pk])
+            if removed:
+                broadcast_members_removed(room_id, [instance.pk])
+    else:
+        invalidate(instance.pk, pk_set)
+        if removed:
+            broadcast_members_removed(instance.pk, pk_set)
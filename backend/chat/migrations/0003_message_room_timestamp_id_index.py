@@ -0,0 +1,19 @@
+# Generated by Django 5.2.6 on 2026-10-18 19:06
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_encryptionrecord_message_encrypted_text'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'timestamp', 'id'], name='chat_msg_room_ts_id_idx'),
+        ),
+    ]
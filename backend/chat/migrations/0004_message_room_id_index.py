@@ -0,0 +1,19 @@
+# Generated by Django 5.2.6 on 2026-10-18 19:07
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_message_room_timestamp_id_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'id'], name='chat_msg_room_id_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 19:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_message_room_id_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='ciphertext',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,57 @@
+import base64
+
+from django.db import migrations, transaction
+
+BATCH_SIZE = 2000
+
+
+def move_ciphertext_inline(apps, schema_editor):
+    """
+    Moves each legacy EncryptionRecord into Message.ciphertext.
+
+    Runs in small id-ordered batches, each committed on its own, so no long
+    transaction holds locks on the message table while it runs. Messages
+    that are not moved yet keep reading from their EncryptionRecord, so the
+    application can serve traffic throughout. A batch copies the ciphertext,
+    clears the messages' encrypted_text and deletes their records in one
+    transaction, so no ciphertext is left stored twice.
+    """
+    Message = apps.get_model('chat', 'Message')
+    EncryptionRecord = apps.get_model('chat', 'EncryptionRecord')
+    db_alias = schema_editor.connection.alias
+
+    last_id = 0
+    while True:
+        batch = list(
+            Message.objects.using(db_alias)
+            .filter(id__gt=last_id, encrypted_text__isnull=False)
+            .select_related('encrypted_text')
+            .only('id', 'ciphertext', 'encrypted_text__encrypted_text')
+            .order_by('id')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+
+        record_ids = [message.encrypted_text_id for message in batch]
+        for message in batch:
+            if message.ciphertext is None:
+                message.ciphertext = base64.urlsafe_b64decode(message.encrypted_text.encrypted_text)
+            message.encrypted_text = None
+        with transaction.atomic(using=db_alias):
+            Message.objects.using(db_alias).bulk_update(batch, ['ciphertext', 'encrypted_text'])
+            # Records cascade to their message, so they only go once nothing points at them.
+            EncryptionRecord.objects.using(db_alias).filter(pk__in=record_ids).delete()
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+    # Each batch commits separately; see move_ciphertext_inline().
+    atomic = False
+
+    dependencies = [
+        ('chat', '0005_message_ciphertext'),
+    ]
+
+    operations = [
+        migrations.RunPython(move_ciphertext_inline, migrations.RunPython.noop),
+    ]
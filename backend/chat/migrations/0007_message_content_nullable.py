@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 19:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_move_encryption_records_inline'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='content',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.6 on 2026-10-18 19:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_message_content_nullable'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KeyRotationCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job', models.CharField(max_length=100)),
+                ('table', models.CharField(max_length=50)),
+                ('stripe', models.PositiveIntegerField()),
+                ('start_id', models.BigIntegerField()),
+                ('end_id', models.BigIntegerField()),
+                ('last_id', models.BigIntegerField()),
+                ('rotated', models.BigIntegerField(default=0)),
+                ('failed', models.BigIntegerField(default=0)),
+                ('finished', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('job', 'table', 'stripe'), name='chat_rotation_stripe_unique')],
+            },
+        ),
+    ]
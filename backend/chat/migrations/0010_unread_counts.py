@@ -0,0 +1,68 @@
+# Generated by Django 6.1.2 on 2026-10-18 21:40
+
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+BATCH_SIZE = 2000
+
+
+def backfill_counts(apps, schema_editor):
+    """
+    Sets each room's message_count and gives every existing member a read
+    cursor at the room's newest message, so upgrading starts with no unread
+    badges instead of whole histories marked unread.
+    """
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    Message = apps.get_model('chat', 'Message')
+    ReadCursor = apps.get_model('chat', 'ReadCursor')
+    Membership = ChatRoom.members.through
+    db_alias = schema_editor.connection.alias
+
+    totals = (
+        Message.objects.using(db_alias).filter(room_id=OuterRef('pk'))
+        .order_by().values('room_id').annotate(total=Count('pk')).values('total')
+    )
+    ChatRoom.objects.using(db_alias).update(message_count=Coalesce(Subquery(totals), 0))
+
+    rooms = {
+        room['pk']: room
+        for room in ChatRoom.objects.using(db_alias)
+        .annotate(last_message_id=Max('messages__id'))
+        .values('pk', 'message_count', 'last_message_id')
+    }
+    memberships = Membership.objects.using(db_alias).values_list('chatroom_id', 'user_id').order_by('pk')
+    batch = []
+    for room_id, user_id in memberships.iterator(chunk_size=BATCH_SIZE):
+        room = rooms[room_id]
+        batch.append(ReadCursor(
+            user_id=user_id,
+            room_id=room_id,
+            last_read_message_id=room['last_message_id'] or 0,
+            read_count=room['message_count'],
+        ))
+        if len(batch) == BATCH_SIZE:
+            ReadCursor.objects.using(db_alias).bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    ReadCursor.objects.using(db_alias).bulk_create(batch, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_readcursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='message_count',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='readcursor',
+            name='read_count',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.6 on 2026-10-18 23:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_unread_counts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageSearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.BigIntegerField()),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_tokens', to='chat.message')),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.chatroom')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room', 'token', 'message'], name='chat_search_room_token_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.6 on 2026-10-18 19:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_messagesearchtoken'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='message',
+            options={},
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='archive_after_days',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='archived_through',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='messagesearchtoken',
+            name='message',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='search_tokens', to='chat.message'),
+        ),
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('timestamp', models.DateTimeField()),
+                ('edited', models.BooleanField(default=False)),
+                ('edited_at', models.DateTimeField(blank=True, null=True)),
+                ('ciphertext', models.BinaryField()),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages', to='chat.chatroom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room', 'timestamp', 'id'], name='chat_archived_room_ts_id_idx'), models.Index(fields=['room', 'id'], name='chat_archived_room_id_idx')],
+            },
+        ),
+    ]
@@ -1,38 +1,61 @@
 import logging
-import os
+from collections import Counter
 
-from cryptography.fernet import Fernet, InvalidToken
+from django.conf import settings
 from django.db import models, transaction
+from django.db.models import Count, Exists, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed
 from django.utils import timezone
-from dotenv import load_dotenv
 
 from authentication.models import User
 
+from . import blind_index
+from . import encryption
+from . import recent
+from .encryption import decrypt_many, decrypt_text, encrypt_bytes, encrypt_many, fernet
+
 # --- Setup logging ---
 # It's a best practice to use Django's logging configuration,
 # but for simplicity in this file, we'll get a basic logger.
 logger = logging.getLogger(__name__)
 
-# --- Securely load and validate the encryption key ---
-load_dotenv()
-fernet_key = os.getenv('FERNET_KEY')
 
-# Initialize fernet instance to None initially
-fernet = None
+class RoomFullError(Exception):
+    """Raised when adding members would take a room past its max_members."""
+
+
+class ChatRoomQuerySet(models.QuerySet):
+    def with_member_info(self, user):
+        """
+        Annotates each room with member_count, whether `user` is a member and
+        the user's unread_count. All three are correlated subqueries (the first
+        two on the membership table, the last a unique-index lookup of the
+        user's ReadCursor), so a page of rooms is a single query with no
+        JOIN + DISTINCT and no COUNT over messages.
+        """
+        memberships = ChatRoom.members.through.objects.filter(chatroom_id=OuterRef('pk'))
+        member_count = (
+            memberships.order_by()
+            .values('chatroom_id')
+            .annotate(total=Count('pk'))
+            .values('total')
+        )
+        return self.annotate(
+            member_count=Coalesce(Subquery(member_count), 0),
+            is_member=Exists(memberships.filter(user_id=user.pk)),
+            # Rooms the user has no cursor in (i.e. is not a member of) count as read.
+            unread_count=Coalesce(
+                F('message_count') - Subquery(
+                    ReadCursor.objects.filter(room_id=OuterRef('pk'), user_id=user.pk).values('read_count')
+                ),
+                0,
+            ),
+        )
 
-if not fernet_key:
-    # Fail loudly at startup if the key is missing. This is a critical configuration error.
-    logger.critical("CRITICAL: FERNET_KEY not found in environment variables. Application cannot start.")
-    # In a real app, this might prevent the server from starting.
-    # For now, we raise an exception.
-    raise ValueError("FERNET_KEY is not set. Please check your .env file or environment variables.")
-else:
-    try:
-        # The key must be bytes. Fernet will validate its format (URL-safe base64-encoded 32-bytes).
-        fernet = Fernet(fernet_key.encode())
-    except (ValueError, TypeError) as e:
-        logger.critical(f"CRITICAL: The provided FERNET_KEY is invalid. Error: {e}")
-        raise ValueError(f"The FERNET_KEY is invalid and cannot be used for encryption. Error: {e}")
+    def visible_to(self, user):
+        """Public rooms plus the private rooms `user` belongs to."""
+        return self.with_member_info(user).filter(Q(is_private=False) | Q(is_member=True))
 
 
 class ChatRoom(models.Model):
@@ -50,6 +73,17 @@ class ChatRoom(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     is_private = models.BooleanField(default=False)
     max_members = models.IntegerField(default=100)
+    # Messages ever posted to the room. Never decremented; unread counts are
+    # the difference between this and ReadCursor.read_count.
+    message_count = models.BigIntegerField(default=0)
+    # Messages older than this many days are moved to ArchivedMessage by the
+    # archive_messages command. None falls back to CHAT_ARCHIVE_AFTER_DAYS.
+    archive_after_days = models.PositiveIntegerField(null=True, blank=True)
+    # Timestamp of the newest archived message; None while nothing is archived.
+    # Reads skip the archive table when they cannot reach this far back.
+    archived_through = models.DateTimeField(null=True, blank=True)
+
+    objects = ChatRoomQuerySet.as_manager()
 
     class Meta:
         ordering = ["-created_at"]
@@ -57,9 +91,59 @@ class ChatRoom(models.Model):
     def __str__(self):
         return self.name
 
+    def add_members(self, user_ids):
+        """
+        Adds users to the room in one transaction, enforcing max_members.
+
+        The room row is locked with SELECT ... FOR UPDATE so concurrent joins are
+        serialised; the capacity check is a single aggregate over the members
+        table and all new memberships are written with one bulk INSERT.
+        Users who are already members are skipped.
+        Returns the set of user ids that were added. Raises RoomFullError.
+        """
+        user_ids = set(user_ids)
+        if not user_ids:
+            return set()
+
+        Membership = ChatRoom.members.through
+        with transaction.atomic():
+            max_members = (
+                ChatRoom.objects.select_for_update()
+                .values_list('max_members', flat=True)
+                .get(pk=self.pk)
+            )
+            counts = Membership.objects.filter(chatroom_id=self.pk).aggregate(
+                total=Count('pk'),
+                existing=Count('pk', filter=Q(user_id__in=user_ids)),
+            )
+            new_ids = user_ids
+            if counts['existing']:
+                new_ids = user_ids - set(
+                    Membership.objects.filter(chatroom_id=self.pk, user_id__in=user_ids)
+                    .values_list('user_id', flat=True)
+                )
+            if not new_ids:
+                return set()
+            if counts['total'] + len(new_ids) > max_members:
+                raise RoomFullError(f'Room "{self.name}" is full.')
+
+            Membership.objects.bulk_create(
+                [Membership(chatroom_id=self.pk, user_id=user_id) for user_id in new_ids]
+            )
+
+        # bulk_create bypasses the related manager, so announce the change the
+        # same way members.add() would for the receivers listening to it.
+        m2m_changed.send(
+            sender=Membership, action='post_add', instance=self, reverse=False,
+            model=User, pk_set=new_ids, using=self._state.db,
+        )
+        return new_ids
+
 class EncryptionRecord(models.Model):
     """
-    Stores the encrypted version of a message's content.
+    Legacy storage for the encrypted version of a message's content.
+    New messages keep their ciphertext inline in Message.ciphertext; these rows
+    are only read for messages written before that column existed.
     """
     encrypted_text = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
@@ -67,6 +151,56 @@ class EncryptionRecord(models.Model):
     def __str__(self):
         return f"Record {self.id} - {self.encrypted_text[:20]}..."
 
+class MessageQuerySet(models.QuerySet):
+    def bulk_send(self, messages, batch_size=1000):
+        """
+        Encrypts and inserts many unsaved messages at once.
+
+        All contents are encrypted up front, then every row is written with
+        bulk_create inside one transaction, so a batch costs a handful of
+        INSERTs instead of one transaction per message. Message.save() is not
+        called and no post_save signal is sent.
+        Returns the new message ids in input order.
+        """
+        messages = list(messages)
+        if not messages:
+            return []
+        if fernet is None:
+            logger.error("Bulk send aborted: Fernet encryption is not initialized.")
+            raise RuntimeError("Cannot save messages because the encryption service is not available.")
+        if any(message.content is None for message in messages):
+            raise ValueError("Cannot save a message without content.")
+
+        plaintexts = [message.content for message in messages]
+        for message, ciphertext in zip(messages, encrypt_many(plaintexts)):
+            message.ciphertext = ciphertext
+            if not settings.CHAT_STORE_PLAINTEXT:
+                message.content = None
+
+        try:
+            with transaction.atomic(using=self.db):
+                self.bulk_create(messages, batch_size=batch_size)
+                for room_id, count in Counter(message.room_id for message in messages).items():
+                    ChatRoom.objects.filter(pk=room_id).update(message_count=F('message_count') + count)
+                ReadCursor.mark_sent(messages)
+                MessageSearchToken.index(zip(messages, plaintexts))
+        finally:
+            for message, plaintext in zip(messages, plaintexts):
+                message.content = plaintext
+        for message, plaintext in zip(messages, plaintexts):
+            encryption.remember(message.pk, message.ciphertext, plaintext)
+        return [message.pk for message in messages]
+
+    def search(self, room, query, before=None, limit=50):
+        """
+        Messages in `room` containing every word of `query`, newest first (see
+        MessageSearchToken.matching). Only searches the hot table; use
+        chat.archive.History to include archived messages.
+        """
+        message_ids = MessageSearchToken.matching(room, query, before=before, limit=limit)
+        return self.filter(id__in=message_ids).order_by('-id')
+
+
 class Message(models.Model):
     """
     Model for chat messages
@@ -75,11 +209,18 @@ class Message(models.Model):
         ChatRoom, on_delete=models.CASCADE, related_name="messages"
     )
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="messages")
-    content = models.TextField()
+    # Plaintext is only written to the table when CHAT_STORE_PLAINTEXT is on.
+    # Otherwise it lives on the instance just long enough to be encrypted.
+    content = models.TextField(null=True, blank=True)
     timestamp = models.DateTimeField(default=timezone.now)
     edited = models.BooleanField(default=False)
     edited_at = models.DateTimeField(blank=True, null=True)
     
+    # Raw Fernet token bytes. Replaces the separate EncryptionRecord row, so a
+    # send is one INSERT and a read needs no join.
+    ciphertext = models.BinaryField(null=True, blank=True)
+
+    # Legacy pointer, only set for messages that predate the ciphertext column.
     encrypted_text = models.OneToOneField(
         EncryptionRecord, 
         on_delete=models.CASCADE, 
@@ -87,39 +228,92 @@ class Message(models.Model):
         blank=True
     )
 
+    objects = MessageQuerySet.as_manager()
+
     class Meta:
-        ordering = ["timestamp"]
+        # No default ordering: every read states its own, so queries that do not
+        # need one (counts, id lookups, bulk jobs) never pay for a sort.
+        indexes = [
+            # Keyset pagination over a room's history seeks on (timestamp, id).
+            models.Index(fields=["room", "timestamp", "id"], name="chat_msg_room_ts_id_idx"),
+            # Delta sync reads a room's messages after a known id.
+            models.Index(fields=["room", "id"], name="chat_msg_room_id_idx"),
+        ]
 
     def __str__(self):
-        return f"{self.user.username}: {self.content[:50]}"
+        content = self.content if self.content is not None else self.decrypted_content
+        return f"{self.user.username}: {content[:50]}"
 
     def save(self, *args, **kwargs):
         """
-        Custom save method to handle encryption within an atomic database transaction.
+        Custom save method that encrypts the content into the inline ciphertext column.
+
+        `content` is only (re-)encrypted when it is set on the instance. Rows loaded
+        from the database with CHAT_STORE_PLAINTEXT off have no plaintext, so saving
+        them leaves the existing ciphertext untouched.
         """
         if fernet is None:
             # This check ensures we don't proceed if the key failed to load.
             logger.error("Message save aborted: Fernet encryption is not initialized.")
             raise RuntimeError("Cannot save message because the encryption service is not available.")
 
-        # Use a transaction to ensure that both the Message and its EncryptionRecord
-        # are saved successfully, or neither is. This prevents orphaned records.
-        with transaction.atomic():
+        plaintext = self.content
+        adding = self._state.adding
+        legacy_record_id = None
+        if plaintext is not None:
             # Encrypt the content before saving.
-            encrypted_content = fernet.encrypt(self.content.encode()).decode()
+            self.ciphertext = encrypt_bytes(plaintext)
+            legacy_record_id = self.encrypted_text_id
+        elif self.ciphertext is None and not self.encrypted_text_id:
+            raise ValueError("Cannot save a message without content.")
 
-            if self.pk and self.encrypted_text:
-                # If the message and its encryption record already exist, update the record.
-                self.encrypted_text.encrypted_text = encrypted_content
-                self.encrypted_text.save()
+        if not settings.CHAT_STORE_PLAINTEXT:
+            self.content = None
+        try:
+            if self._state.adding:
+                # New messages bump the room's counter, move the sender's read cursor
+                # and add their search tokens in the same transaction, so all of it is
+                # committed together.
+                with transaction.atomic():
+                    super().save(*args, **kwargs)
+                    ChatRoom.objects.filter(pk=self.room_id).update(message_count=F('message_count') + 1)
+                    ReadCursor.mark_sent([self])
+                    MessageSearchToken.index([(self, plaintext)])
+            elif plaintext is None:
+                # Nothing was re-encrypted, so the search tokens are still current.
+                super().save(*args, **kwargs)
             else:
-                # If it's a new message, create a new encryption record.
-                record = EncryptionRecord.objects.create(encrypted_text=encrypted_content)
-                self.encrypted_text = record
-            
-            # Call the original save() method to save the Message instance.
-            # This happens inside the transaction block.
-            super().save(*args, **kwargs)
+                # An edit: the new ciphertext and its search tokens are written in one
+                # transaction. A message that still points at a legacy EncryptionRecord
+                # is moved onto the inline column and the old row dropped in the same
+                # transaction, so it is never left without ciphertext.
+                with transaction.atomic():
+                    if legacy_record_id:
+                        self.encrypted_text = None
+                    super().save(*args, **kwargs)
+                    if legacy_record_id:
+                        EncryptionRecord.objects.filter(pk=legacy_record_id).delete()
+                    MessageSearchToken.index([(self, plaintext)], replace=True)
+        finally:
+            # Keep the plaintext available to the caller (e.g. the create response).
+            self.content = plaintext
+
+        # Drop any plaintext cached by prefetch_decrypted(); it may be stale now.
+        self.__dict__.pop('_decrypted_content', None)
+        if plaintext is not None:
+            # New text replaces the cached plaintext of an edited message, and
+            # a new message is cached before anyone reads it.
+            encryption.remember(self.pk, self.ciphertext, plaintext)
+        if not adding:
+            # The room's cached newest messages may hold the old version.
+            recent.messages.invalidate(self.room.slug)
+
+    def delete(self, *args, **kwargs):
+        slug = self.room.slug
+        result = super().delete(*args, **kwargs)
+        # Queryset deletes skip this and only drop out of the cache when it expires.
+        recent.messages.invalidate(slug)
+        return result
 
     @property
     def decrypted_content(self):
@@ -127,25 +321,220 @@ class Message(models.Model):
         A property to safely access the decrypted content of the message.
         Handles potential decryption errors gracefully.
         """
-        if not self.encrypted_text or not self.encrypted_text.encrypted_text:
-            logger.warning(f"Message {self.id} has no associated encrypted text to decrypt.")
-            return "[No Content]"
+        if hasattr(self, '_decrypted_content'):
+            # Already filled in by prefetch_decrypted() for a whole page.
+            return self._decrypted_content
 
-        try:
-            # Decrypt the text from the related EncryptionRecord
-            encrypted_bytes = self.encrypted_text.encrypted_text.encode()
-            decrypted_bytes = fernet.decrypt(encrypted_bytes)
-            return decrypted_bytes.decode()
-        except InvalidToken:
-            # This is the specific exception for failed decryption.
-            # It could mean the data is corrupt or the encryption key has changed.
-            logger.error(
-                f"DECRYPTION FAILED for Message ID {self.id}. "
-                "The token is invalid. This may be due to data corruption or a key change."
+        if self.ciphertext is not None:
+            return decrypt_text(self.ciphertext, self.id)
+        record = self.encrypted_text
+        return decrypt_text(record.encrypted_text if record else None, self.id)
+
+    @classmethod
+    def prefetch_decrypted(cls, messages, use_cache=True):
+        """
+        Decrypts a page of messages in one pass and stores the plaintext on each
+        instance so decrypted_content does no further work.
+        use_cache=False bypasses the decryption cache (see decrypt_many).
+        Messages that only have a legacy EncryptionRecord get their records
+        loaded with a single query instead of one lazy OneToOne lookup per row.
+        """
+        pending = [m for m in messages if not hasattr(m, '_decrypted_content')]
+        if not pending:
+            return messages
+
+        # Archived messages can be mixed in; they never have a legacy record.
+        legacy = [m for m in pending if m.ciphertext is None and getattr(m, 'encrypted_text_id', None)]
+        # Records already loaded via select_related are reused as-is.
+        cached = {
+            m.encrypted_text_id: m.encrypted_text
+            for m in legacy
+            if cls.encrypted_text.is_cached(m)
+        }
+        missing = {m.encrypted_text_id for m in legacy} - cached.keys()
+        records = {**cached, **EncryptionRecord.objects.in_bulk(missing)}
+
+        tokens = {}
+        for message in pending:
+            if message.ciphertext is not None:
+                tokens[message.id] = message.ciphertext
+                continue
+            record = records.get(message.encrypted_text_id)
+            tokens[message.id] = record.encrypted_text if record else None
+
+        plaintexts = decrypt_many(tokens, use_cache=use_cache)
+        for message in pending:
+            message._decrypted_content = plaintexts[message.id]
+        return messages
+
+
+class ArchivedMessage(models.Model):
+    """
+    Cold storage for messages older than their room's retention age (see
+    chat.archive). Rows keep the id they had in Message, so read cursors,
+    search tokens and client cursors stay valid, and only the inline
+    ciphertext is stored: archiving drops plaintext and legacy records.
+    Archived messages are read-only.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name="archived_messages")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    timestamp = models.DateTimeField()
+    edited = models.BooleanField(default=False)
+    edited_at = models.DateTimeField(blank=True, null=True)
+    ciphertext = models.BinaryField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["room", "timestamp", "id"], name="chat_archived_room_ts_id_idx"),
+            models.Index(fields=["room", "id"], name="chat_archived_room_id_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username}: {self.decrypted_content[:50]}"
+
+    @property
+    def decrypted_content(self):
+        if hasattr(self, '_decrypted_content'):
+            return self._decrypted_content
+        return decrypt_text(self.ciphertext, self.id)
+
+
+class KeyRotationCheckpoint(models.Model):
+    """
+    Progress of one stripe of a key rotation job (see the rotate_encryption_keys command).
+    Each stripe covers an id range of one table; last_id lets an interrupted
+    job resume where it stopped.
+    """
+    job = models.CharField(max_length=100)
+    table = models.CharField(max_length=50)
+    stripe = models.PositiveIntegerField()
+    start_id = models.BigIntegerField()
+    end_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    rotated = models.BigIntegerField(default=0)
+    failed = models.BigIntegerField(default=0)
+    finished = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["job", "table", "stripe"], name="chat_rotation_stripe_unique"),
+        ]
+
+    def __str__(self):
+        return f"{self.job}/{self.table}#{self.stripe}: {self.last_id}/{self.end_id}"
+
+
+class ReadCursor(models.Model):
+    """
+    The newest message a user has read in a room. Updated in bulk by
+    chat.receipts rather than on every read event, and by sends, since
+    people have read what they sent.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="read_cursors")
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name="read_cursors")
+    last_read_message_id = models.BigIntegerField(default=0)
+    # The room's message_count minus the messages after last_read_message_id.
+    read_count = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "room"], name="chat_read_cursor_unique"),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} read {self.room.name} up to {self.last_read_message_id}"
+
+    @classmethod
+    def mark_sent(cls, messages):
+        """
+        Moves each sender's cursor up to their newest message in `messages`.
+        Runs inside the send's transaction, after the room's message_count was
+        bumped: one UPDATE per sender and room, and no receipts broadcast,
+        since the message itself tells the room who has read it.
+        """
+        newest = {}
+        for message in messages:
+            key = (message.user_id, message.room_id)
+            newest[key] = max(newest.get(key, 0), message.pk)
+        for (user_id, room_id), message_id in newest.items():
+            # Normally nothing: only messages sent concurrently come after the sender's own.
+            after = (
+                Message.objects.filter(room_id=room_id, id__gt=message_id)
+                .order_by()
+                .values('room_id')
+                .annotate(total=Count('pk'))
+                .values('total')
+            )
+            cls.objects.filter(user_id=user_id, room_id=room_id, last_read_message_id__lt=message_id).update(
+                last_read_message_id=message_id,
+                read_count=Subquery(ChatRoom.objects.filter(pk=room_id).values('message_count'))
+                - Coalesce(Subquery(after), 0),
+                updated_at=timezone.now(),
             )
-            return "[DECRYPTION FAILED: Invalid Token]"
-        except Exception as e:
-            # Catch any other unexpected errors during decryption.
-            logger.error(f"An unexpected error occurred during decryption for Message ID {self.id}: {e}")
-            return "[DECRYPTION FAILED: Unexpected Error]"
-        
+
+
+class MessageSearchToken(models.Model):
+    """
+    One blinded word of one message: the postings table behind message search.
+    Tokens are keyed HMACs (see chat.blind_index), never plaintext.
+    """
+    # Not enforced by the database: tokens keep pointing at a message after it
+    # moves to ArchivedMessage under the same id.
+    message = models.ForeignKey(
+        Message, on_delete=models.DO_NOTHING, db_constraint=False, related_name="search_tokens"
+    )
+    # Denormalised from the message so a room's postings are one index range.
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name="+")
+    token = models.BigIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["room", "token", "message"], name="chat_search_room_token_idx"),
+        ]
+
+    @classmethod
+    def matching(cls, room, query, before=None, limit=50):
+        """
+        Ids of the messages in `room` containing every word of `query`, newest
+        first, found through the blind index without decrypting anything. A
+        64-bit digest collision can produce a false match, so callers that show
+        results should confirm them against the decrypted text (see
+        matches_query). `before` continues a previous page from that message id.
+        """
+        tokens = [blind_index.blind(word) for word in blind_index.words(query)]
+        if not tokens:
+            return []
+        postings = cls.objects.filter(room=room, token__in=tokens)
+        if before is not None:
+            postings = postings.filter(message_id__lt=before)
+        return list(
+            postings.values('message_id')
+            .annotate(matched=Count('token', distinct=True))
+            .filter(matched=len(set(tokens)))
+            .order_by('-message_id')
+            .values_list('message_id', flat=True)[:limit]
+        )
+
+    @classmethod
+    def index(cls, messages_with_text, replace=False, batch_size=5000):
+        """
+        Writes the search tokens for (message, plaintext) pairs.
+        With replace=True the messages' existing tokens are deleted first (edits).
+        Does nothing when search is not configured.
+        """
+        if not blind_index.is_enabled():
+            return
+        messages_with_text = list(messages_with_text)
+        if replace:
+            cls.objects.filter(message__in=[message.pk for message, _ in messages_with_text]).delete()
+        cls.objects.bulk_create(
+            [
+                cls(message_id=message.pk, room_id=message.room_id, token=token)
+                for message, text in messages_with_text
+                for token in blind_index.blind_words(text)
+            ],
+            batch_size=batch_size,
+        )
@@ -0,0 +1,127 @@
+"""
+Global event feed for the monitoring dashboard (ws/monitoring/).
+
+Mirroring every chat message to every dashboard would double the fan-out
+cost, so the feed is deliberately lossy:
+
+- Only a CHAT_MONITORING_SAMPLE_RATE fraction of messages is published as
+  individual events. Publishing never awaits the channel layer on the chat
+  path; it is scheduled as a background task. Sends from synchronous REST
+  views hand the event to the feed's event loop without waiting for it.
+- Every message is counted per room, and each process publishes the totals
+  as one aggregated `monitor.stats` event every CHAT_MONITORING_STATS_INTERVAL
+  seconds.
+- Each dashboard connection buffers events in a bounded queue that drops the
+  oldest entries when the client falls behind (see MonitoringConsumer).
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+from collections import Counter
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .encryption import to_token
+
+logger = logging.getLogger(__name__)
+
+MONITORING_GROUP = 'monitoring'
+
+# Enough of the token to show on the dashboard without shipping whole messages.
+CIPHERTEXT_PREVIEW_LENGTH = 64
+
+
+def _log_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Failed to publish monitoring event: {task.exception()}")
+
+
+class MonitoringFeed:
+    def __init__(self):
+        self._counts = Counter()
+        self._lock = threading.Lock()
+        self._stats_task = None
+        # The event loop the stats task runs on. REST sends publish through it.
+        self._loop = None
+
+    def _count(self, room_id):
+        with self._lock:
+            self._counts[room_id] += 1
+
+    def _sampled(self):
+        rate = settings.CHAT_MONITORING_SAMPLE_RATE
+        return rate > 0 and random.random() < rate
+
+    def _event(self, room_id, message_id, ciphertext):
+        return {
+            'type': 'monitor.event',
+            'event': {
+                'type': 'new_encrypted_message',
+                'id': message_id,
+                'room_id': room_id,
+                'encrypted_text': to_token(ciphertext).decode()[:CIPHERTEXT_PREVIEW_LENGTH],
+            },
+        }
+
+    def _publish(self, event):
+        task = asyncio.ensure_future(get_channel_layer().group_send(MONITORING_GROUP, event))
+        task.add_done_callback(_log_failure)
+
+    def record(self, room_id, message_id, ciphertext):
+        """Records a message sent from async code. Never waits on the channel layer."""
+        self._count(room_id)
+        self.ensure_stats_task()
+        if self._sampled():
+            self._publish(self._event(room_id, message_id, ciphertext))
+
+    def record_sync(self, room_id, message_id, ciphertext):
+        """
+        Records a message sent from synchronous code (REST views). Never waits
+        on the channel layer: the event is scheduled on the feed's event loop.
+        Until a socket has started the feed in this process there is no loop
+        to schedule on, and sampled events are dropped.
+        """
+        self._count(room_id)
+        loop = self._loop
+        if loop is None or loop.is_closed() or not self._sampled():
+            return
+        try:
+            loop.call_soon_threadsafe(self._publish, self._event(room_id, message_id, ciphertext))
+        except RuntimeError:
+            # The loop closed in the meantime.
+            pass
+
+    def ensure_stats_task(self):
+        """Starts the periodic stats publisher on the running event loop, once."""
+        if self._stats_task is None or self._stats_task.done():
+            self._loop = asyncio.get_running_loop()
+            self._stats_task = self._loop.create_task(self._publish_stats())
+
+    async def _publish_stats(self):
+        interval = settings.CHAT_MONITORING_STATS_INTERVAL
+        channel_layer = get_channel_layer()
+        while True:
+            await asyncio.sleep(interval)
+            with self._lock:
+                counts, self._counts = self._counts, Counter()
+            if not counts:
+                continue
+            try:
+                await channel_layer.group_send(MONITORING_GROUP, {
+                    'type': 'monitor.stats',
+                    'stats': {
+                        'type': 'room_throughput',
+                        'source': os.getpid(),
+                        'interval': interval,
+                        'rooms': {str(room_id): count for room_id, count in counts.items()},
+                    },
+                })
+            except Exception as e:
+                logger.error(f"Failed to publish monitoring stats: {e}")
+
+
+# One feed per process.
+feed = MonitoringFeed()
@@ -0,0 +1,186 @@
+"""
+Online presence for WebSocket users.
+
+Live state is kept in memory, per process. Heartbeats only touch a dict and
+a timing wheel; nothing is written to the database on the hot path. Users
+whose last heartbeat is older than CHAT_PRESENCE_TTL fall off the wheel and
+go offline. Every CHAT_PRESENCE_FLUSH_INTERVAL seconds the accumulated
+changes are written to authentication.UserActivity with one bulk UPDATE
+(plus one bulk INSERT for users seen for the first time), which is what
+other processes read.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from authentication.models import UserActivity
+
+from .models import ChatRoom
+
+logger = logging.getLogger(__name__)
+
+
+class TimingWheel:
+    """
+    Hashed timing wheel: keys are bucketed by the tick they expire on, so
+    scheduling, rescheduling and expiring are all O(1) per key.
+    """
+
+    def __init__(self, slots, tick=1.0):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.deadlines = {}
+        self.current = self._tick_at(time.monotonic())
+
+    def _tick_at(self, now):
+        return int(now / self.tick)
+
+    def schedule(self, key, delay, now=None):
+        now = time.monotonic() if now is None else now
+        self.cancel(key)
+        deadline = self._tick_at(now + delay) + 1
+        self.deadlines[key] = deadline
+        self.slots[deadline % len(self.slots)].add(key)
+
+    def cancel(self, key):
+        deadline = self.deadlines.pop(key, None)
+        if deadline is not None:
+            self.slots[deadline % len(self.slots)].discard(key)
+
+    def advance(self, now=None):
+        """Moves the wheel up to `now` and returns the keys that expired."""
+        target = self._tick_at(time.monotonic() if now is None else now)
+        expired = []
+        first = max(self.current + 1, target - len(self.slots) + 1)
+        for tick in range(first, target + 1):
+            slot = self.slots[tick % len(self.slots)]
+            for key in [key for key in slot if self.deadlines[key] <= target]:
+                slot.discard(key)
+                del self.deadlines[key]
+                expired.append(key)
+        self.current = max(self.current, target)
+        return expired
+
+
+class PresenceTracker:
+    def __init__(self, ttl=None):
+        self.ttl = settings.CHAT_PRESENCE_TTL if ttl is None else ttl
+        self._lock = threading.Lock()
+        self._connections = Counter()
+        self._last_seen = {}
+        self._dirty = {}
+        self._wheel = TimingWheel(slots=int(self.ttl) + 2)
+        self._flush_task = None
+
+    def connect(self, user_id):
+        with self._lock:
+            self._connections[user_id] += 1
+        self.heartbeat(user_id)
+
+    def heartbeat(self, user_id):
+        now = timezone.now()
+        with self._lock:
+            self._last_seen[user_id] = now
+            self._dirty[user_id] = (True, now)
+            self._wheel.schedule(user_id, self.ttl)
+
+    def disconnect(self, user_id):
+        with self._lock:
+            self._connections[user_id] -= 1
+            if self._connections[user_id] > 0:
+                return
+            del self._connections[user_id]
+            self._wheel.cancel(user_id)
+            last_seen = self._last_seen.pop(user_id, timezone.now())
+            self._dirty[user_id] = (False, last_seen)
+
+    def expire(self):
+        """Takes users whose heartbeats stopped offline."""
+        with self._lock:
+            for user_id in self._wheel.advance():
+                self._connections.pop(user_id, None)
+                last_seen = self._last_seen.pop(user_id, timezone.now())
+                self._dirty[user_id] = (False, last_seen)
+
+    def online_user_ids(self):
+        """Users online through this process."""
+        self.expire()
+        with self._lock:
+            return set(self._last_seen)
+
+    def is_online(self, user_id):
+        return user_id in self.online_user_ids()
+
+    def flush(self):
+        """Writes pending presence changes to UserActivity in bulk."""
+        self.expire()
+        with self._lock:
+            pending, self._dirty = self._dirty, {}
+        if not pending:
+            return 0
+
+        try:
+            activities = UserActivity.objects.in_bulk(pending.keys(), field_name='user_id')
+            for user_id, activity in activities.items():
+                activity.is_online, activity.last_seen = pending[user_id]
+            UserActivity.objects.bulk_update(activities.values(), ['is_online', 'last_seen'])
+            UserActivity.objects.bulk_create(
+                [
+                    UserActivity(user_id=user_id, is_online=is_online, last_seen=last_seen)
+                    for user_id, (is_online, last_seen) in pending.items()
+                    if user_id not in activities
+                ],
+                ignore_conflicts=True,
+            )
+        except Exception:
+            # Put the changes back (newer ones win) so the next flush retries them.
+            with self._lock:
+                self._dirty = {**pending, **self._dirty}
+            raise
+        return len(pending)
+
+    def ensure_flush_task(self):
+        """Starts the periodic flush on the running event loop, once."""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(settings.CHAT_PRESENCE_FLUSH_INTERVAL)
+            try:
+                await database_sync_to_async(self.flush)()
+            except Exception as e:
+                logger.error(f"Failed to flush presence: {e}")
+
+    def online_in_rooms(self, room_ids):
+        """
+        Returns {room_id: set(user_ids)} of online members for several rooms in one query.
+        Combines users online in this process with users that other processes
+        have flushed as online within the TTL.
+        """
+        recent = timezone.now() - timedelta(seconds=self.ttl + settings.CHAT_PRESENCE_FLUSH_INTERVAL)
+        flushed_online = Q(user__useractivity__is_online=True, user__useractivity__last_seen__gte=recent)
+        local = self.online_user_ids()
+        condition = flushed_online | Q(user_id__in=local) if local else flushed_online
+
+        online = {room_id: set() for room_id in room_ids}
+        rows = (
+            ChatRoom.members.through.objects
+            .filter(condition, chatroom_id__in=room_ids)
+            .values_list('chatroom_id', 'user_id')
+        )
+        for room_id, user_id in rows:
+            online[room_id].add(user_id)
+        return online
+
+
+# One tracker per process.
+tracker = PresenceTracker()
@@ -0,0 +1,267 @@
+"""
+Typing indicators and read receipts.
+
+Both arrive far more often than messages and are worth little individually,
+so neither is written or broadcast one event at a time:
+
+- Typing events are ephemeral. They never touch the database, and each user
+  gets at most one "is typing" broadcast per room every CHAT_TYPING_DEBOUNCE
+  seconds. A "stopped typing" event is only sent if a start was sent before it.
+- Read events move a per-user, per-room cursor in memory. Updates are merged
+  by keeping the highest message id. Every CHAT_READ_RECEIPT_FLUSH_INTERVAL
+  seconds the cursors that moved are upserted into ReadCursor in one
+  statement, and each affected room gets one `receipts` event listing them.
+  Sending a message moves the sender's own cursor inside the send's
+  transaction instead (see ReadCursor.mark_sent).
+
+Each cursor also stores read_count, the number of the room's messages up to
+the cursor. Unread counts are then ChatRoom.message_count - read_count and
+never need a COUNT over the room's messages (see ChatRoomQuerySet.with_member_info).
+read_count is recomputed when a cursor moves, by counting only the messages
+after it.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce, Greatest
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
+
+from .fanout import broadcast_event, room_group_name
+from .models import ArchivedMessage, ChatRoom, Message, ReadCursor
+
+logger = logging.getLogger(__name__)
+
+
+def newest_message_id():
+    """
+    A ChatRoom expression for the id of the room's newest message, 0 for an
+    empty room. Archived messages count too. Each room costs one index seek
+    per table.
+    """
+    def newest(model):
+        return Coalesce(Subquery(
+            model.objects.filter(room_id=OuterRef('pk')).order_by('-id').values('id')[:1]
+        ), 0)
+
+    return Greatest(newest(Message), newest(ArchivedMessage))
+
+
+def newest_message_ids(room_ids):
+    """{room_id: id of the room's newest message} for the given rooms (see newest_message_id)."""
+    return dict(
+        ChatRoom.objects.filter(pk__in=room_ids)
+        .annotate(newest_id=newest_message_id())
+        .values_list('pk', 'newest_id')
+    )
+
+
+def receipts_event(cursors):
+    """The `receipts` event for [(user_id, message_id), ...] in one room."""
+    return {
+        'type': 'receipts',
+        'receipts': [
+            {'user_id': user_id, 'last_read_message_id': message_id} for user_id, message_id in cursors
+        ],
+    }
+
+
+class TypingDebouncer:
+    def __init__(self, interval=None):
+        self.interval = settings.CHAT_TYPING_DEBOUNCE if interval is None else interval
+        self._last_sent = {}
+
+    def should_send(self, room_id, user_id, is_typing):
+        """Whether this typing event should be broadcast to the room."""
+        key = (room_id, user_id)
+        if not is_typing:
+            return self._last_sent.pop(key, None) is not None
+        now = time.monotonic()
+        last_sent = self._last_sent.get(key)
+        if last_sent is not None and now - last_sent < self.interval:
+            return False
+        self._last_sent[key] = now
+        return True
+
+
+class ReadCursorBuffer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flush_task = None
+
+    def mark_read(self, user_id, room_id, message_id):
+        """Moves the user's cursor forward in memory. Older ids are ignored."""
+        key = (user_id, room_id)
+        with self._lock:
+            if message_id > self._pending.get(key, 0):
+                self._pending[key] = message_id
+
+    def mark_read_now(self, user_id, room_id, message_id):
+        """
+        Moves a cursor and broadcasts the receipt straight away, for synchronous
+        code (REST views) that has no flush loop running next to it.
+        """
+        moved = self.write({(user_id, room_id): message_id})
+        if moved:
+            broadcast_event(room_id, receipts_event(moved[room_id]))
+
+    def flush(self):
+        """
+        Writes the pending cursors (see write()).
+        Returns {room_id: [(user_id, message_id), ...]} for the cursors that moved.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return {}
+
+        try:
+            return self.write(pending)
+        except Exception:
+            # Merge the changes back so the next flush retries them.
+            with self._lock:
+                for key, message_id in pending.items():
+                    if message_id > self._pending.get(key, 0):
+                        self._pending[key] = message_id
+            raise
+
+    def write(self, cursors):
+        """
+        Upserts {(user_id, room_id): message_id} cursors that are ahead of what is
+        stored, then recomputes their read_count with one UPDATE.
+        Returns {room_id: [(user_id, message_id), ...]} for the cursors that moved.
+        """
+        newest = newest_message_ids({room_id for _, room_id in cursors})
+        # A cursor can never pass the room's newest message, or the user could
+        # not mark the room read again once real messages caught up with it.
+        cursors = {(user_id, room_id): min(message_id, newest.get(room_id, 0))
+                   for (user_id, room_id), message_id in cursors.items()}
+        with transaction.atomic():
+            stored = {
+                (user_id, room_id): last_read
+                for user_id, room_id, last_read in ReadCursor.objects.filter(
+                    user_id__in={user_id for user_id, _ in cursors},
+                    room_id__in={room_id for _, room_id in cursors},
+                ).values_list('user_id', 'room_id', 'last_read_message_id')
+            }
+            advanced = [
+                ReadCursor(user_id=user_id, room_id=room_id, last_read_message_id=message_id)
+                for (user_id, room_id), message_id in cursors.items()
+                # Cursors stored past the room's newest message (before ids were clamped) are pulled back.
+                if message_id > stored.get((user_id, room_id), 0)
+                or stored.get((user_id, room_id), 0) > newest.get(room_id, 0)
+            ]
+            if not advanced:
+                return {}
+            ReadCursor.objects.bulk_create(
+                advanced,
+                update_conflicts=True,
+                unique_fields=['user', 'room'],
+                update_fields=['last_read_message_id', 'updated_at'],
+            )
+
+            # Messages after the cursor are found with a range scan of the
+            # (room, id) index of each table; for a reader who is caught up that
+            # is a handful of hot rows and none in the archive.
+            def unread(model):
+                return Coalesce(Subquery(
+                    model.objects.filter(room_id=OuterRef('room_id'), id__gt=OuterRef('last_read_message_id'))
+                    .order_by()
+                    .values('room_id')
+                    .annotate(total=Count('pk'))
+                    .values('total')
+                ), 0)
+
+            posted = ChatRoom.objects.filter(pk=OuterRef('room_id')).values('message_count')
+            moved = Q()
+            for cursor in advanced:
+                moved |= Q(user_id=cursor.user_id, room_id=cursor.room_id)
+            ReadCursor.objects.filter(moved).update(
+                read_count=Coalesce(Subquery(posted), 0) - unread(Message) - unread(ArchivedMessage)
+            )
+
+        by_room = defaultdict(list)
+        for cursor in advanced:
+            by_room[cursor.room_id].append((cursor.user_id, cursor.last_read_message_id))
+        return dict(by_room)
+
+    def cursors_in_room(self, room_id):
+        """Returns {user_id: last_read_message_id} for a room, including unflushed reads."""
+        cursors = dict(
+            ReadCursor.objects.filter(room_id=room_id).values_list('user_id', 'last_read_message_id')
+        )
+        with self._lock:
+            for (user_id, pending_room_id), message_id in self._pending.items():
+                if pending_room_id == room_id and message_id > cursors.get(user_id, 0):
+                    cursors[user_id] = message_id
+        newest = newest_message_ids([room_id])[room_id]
+        return {user_id: min(message_id, newest) for user_id, message_id in cursors.items()}
+
+    def ensure_flush_task(self):
+        """Starts the periodic flush on the running event loop, once."""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        channel_layer = get_channel_layer()
+        while True:
+            await asyncio.sleep(settings.CHAT_READ_RECEIPT_FLUSH_INTERVAL)
+            try:
+                advanced = await database_sync_to_async(self.flush)()
+                for room_id, cursors in advanced.items():
+                    await channel_layer.group_send(
+                        room_group_name(room_id), {'type': 'chat.batch', 'events': [receipts_event(cursors)]}
+                    )
+            except Exception as e:
+                logger.error(f"Failed to flush read receipts: {e}")
+
+
+@receiver(m2m_changed, sender=ChatRoom.members.through)
+def members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """New members start with everything read; leaving drops the cursor."""
+    if action not in ('post_add', 'post_remove') or not pk_set:
+        return
+    if reverse:
+        pairs = [(instance.pk, room_id) for room_id in pk_set]
+    else:
+        pairs = [(user_id, instance.pk) for user_id in pk_set]
+
+    if action == 'post_remove':
+        removed = Q()
+        for user_id, room_id in pairs:
+            removed |= Q(user_id=user_id, room_id=room_id)
+        ReadCursor.objects.filter(removed).delete()
+        return
+
+    rooms = {
+        room['pk']: room
+        for room in ChatRoom.objects.filter(pk__in={room_id for _, room_id in pairs})
+        .annotate(last_message_id=newest_message_id())
+        .values('pk', 'message_count', 'last_message_id')
+    }
+    ReadCursor.objects.bulk_create(
+        [
+            ReadCursor(
+                user_id=user_id,
+                room_id=room_id,
+                last_read_message_id=rooms[room_id]['last_message_id'],
+                read_count=rooms[room_id]['message_count'],
+            )
+            for user_id, room_id in pairs
+        ],
+        ignore_conflicts=True,
+    )
+
+
+# One of each per process.
+typing = TypingDebouncer()
+read_cursors = ReadCursorBuffer()
@@ -0,0 +1,130 @@
+"""
+Per-room cache of the newest messages, already serialized and decrypted.
+
+Opening a room loads its newest page, and in a busy room every member
+loads the same one. Each room therefore gets a ring buffer of its
+CHAT_RECENT_MESSAGES_SIZE newest messages. The buffer is filled by the
+first request that misses, and messages sent through this process (REST
+or WebSocket) are appended to it. Editing or deleting a message, and bulk
+sends, drop the room's buffer. Buffers are kept for at most
+CHAT_RECENT_MESSAGES_ROOMS rooms, least recently used first out. They
+expire after CHAT_RECENT_MESSAGES_TTL seconds, which is how messages
+written by other processes show up.
+"""
+import threading
+from collections import deque, namedtuple
+
+from django.conf import settings
+
+from chatbot.cache import BoundedCache
+
+# `data` is the MessageSerializer output. `pk` and `timestamp` are kept for
+# ordering and for building keyset cursors.
+RecentMessage = namedtuple('RecentMessage', ['pk', 'timestamp', 'data'])
+
+
+class RoomBuffer:
+    def __init__(self, room_id, rows, truncated, count, size):
+        self.room_id = room_id
+        # Oldest first, so new messages are appended at the right.
+        self.rows = deque(rows, maxlen=size)
+        # Whether the room has messages older than the oldest row here.
+        self.truncated = truncated
+        # Messages in the room's whole history. Only page-number responses need
+        # it, so it stays None until one of them counts the room.
+        self.count = count
+
+    def has_older(self, limit):
+        """Whether there are messages beyond the newest `limit`."""
+        return len(self.rows) > limit or self.truncated
+
+    def newest(self, limit):
+        """Up to `limit` messages, newest first."""
+        rows = list(self.rows)[-limit:]
+        rows.reverse()
+        return rows
+
+
+class RecentMessages:
+    def __init__(self):
+        self.size = settings.CHAT_RECENT_MESSAGES_SIZE
+        self._rooms = BoundedCache(
+            maxsize=settings.CHAT_RECENT_MESSAGES_ROOMS,
+            ttl=settings.CHAT_RECENT_MESSAGES_TTL,
+        )
+        self._lock = threading.Lock()
+        # Every write (append or invalidate) takes the next sequence number and
+        # records it for its room. A fill only stores its rows if its room has
+        # not been written since version() was read. Like the buffers, the
+        # record is kept for at most CHAT_RECENT_MESSAGES_ROOMS rooms. Rooms
+        # dropped from it count as written when the oldest was dropped
+        # (`_floor`), so at worst a fill is not stored.
+        self._seq = 0
+        self._floor = 0
+        self._written = BoundedCache(maxsize=settings.CHAT_RECENT_MESSAGES_ROOMS)
+
+    def get(self, slug):
+        return self._rooms.get(slug)
+
+    def version(self):
+        with self._lock:
+            return self._seq
+
+    def _record_write(self, slug):
+        # Called with the lock held.
+        self._seq += 1
+        evictions = self._written.evictions
+        self._written.set(slug, self._seq)
+        if self._written.evictions != evictions:
+            self._floor = self._seq
+
+    def fill(self, slug, room_id, messages, truncated, count, version):
+        """
+        Caches a room's newest messages, given newest first as model instances
+        with their serialized data. `truncated` says whether the room has older
+        messages and `count` is its total, if known. `version` is version()
+        from before they were read. Returns the buffer, cached or not.
+        """
+        rows = [RecentMessage(message.pk, message.timestamp, data) for message, data in messages]
+        rows.reverse()
+        buffer = RoomBuffer(room_id, rows, truncated, count, self.size)
+        with self._lock:
+            if self._written.get(slug, self._floor) <= version:
+                self._rooms.set(slug, buffer)
+        return buffer
+
+    def append(self, slug, message, data):
+        """Adds a message just sent to the room, if the room is cached."""
+        row = RecentMessage(message.pk, message.timestamp, data)
+        with self._lock:
+            self._record_write(slug)
+            buffer = self._rooms.get(slug)
+            if buffer is None or any(cached.pk == row.pk for cached in buffer.rows):
+                return
+            if buffer.count is not None:
+                buffer.count += 1
+            if len(buffer.rows) == buffer.rows.maxlen:
+                buffer.truncated = True
+            buffer.rows.append(row)
+            # Concurrent sends can finish out of order.
+            if len(buffer.rows) > 1 and (buffer.rows[-2].timestamp, buffer.rows[-2].pk) > (row.timestamp, row.pk):
+                buffer.rows = deque(sorted(buffer.rows, key=lambda r: (r.timestamp, r.pk)), maxlen=self.size)
+
+    def set_count(self, buffer, count):
+        """Records a room's message count on its buffer, unless a send got there first."""
+        with self._lock:
+            if buffer.count is None:
+                buffer.count = count
+
+    def invalidate(self, slug):
+        """Drops a room's buffer, e.g. after a bulk send."""
+        with self._lock:
+            self._record_write(slug)
+            self._rooms.delete(slug)
+
+    def stats(self):
+        return self._rooms.stats()
+
+
+# One cache per process.
+messages = RecentMessages()
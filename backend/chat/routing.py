@@ -0,0 +1,13 @@
+from django.urls import path
+
+from . import consumers
+
+websocket_urlpatterns = [
+    # Live messages for a room
+    # WS -> /ws/chat/<slug>/
+    path('ws/chat/<slug:slug>/', consumers.ChatConsumer.as_asgi()),
+
+    # Sampled feed of encrypted traffic and per-room throughput (staff only)
+    # WS -> /ws/monitoring/
+    path('ws/monitoring/', consumers.MonitoringConsumer.as_asgi()),
+]
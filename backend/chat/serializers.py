@@ -12,6 +12,18 @@ class UserSerializer(serializers.ModelSerializer):
 
 # --- Message Serializers ---
 
+class MessageListSerializer(serializers.ListSerializer):
+    """
+    List serializer for message pages.
+    Decrypts the whole page in one batch before the per-row serializers run,
+    so get_content() never triggers its own query or decrypt call.
+    """
+    def to_representation(self, data):
+        messages = list(data.all() if hasattr(data, 'all') else data)
+        Message.prefetch_decrypted(messages)
+        return super().to_representation(messages)
+
+
 class MessageSerializer(serializers.ModelSerializer):
     """
     Serializer for listing/retrieving chat messages.
@@ -26,6 +38,7 @@ class MessageSerializer(serializers.ModelSerializer):
         # The 'content' in this list now refers to our SerializerMethodField above.
         fields = ['id', 'user', 'content', 'timestamp', 'edited']
         read_only_fields = ['user', 'timestamp', 'edited']
+        list_serializer_class = MessageListSerializer
 
     def get_content(self, obj):
         """
@@ -38,30 +51,51 @@ class MessageSerializer(serializers.ModelSerializer):
 class MessageCreateSerializer(serializers.ModelSerializer):
     """
     Serializer used specifically for creating (sending) a new message.
-    --- NO CHANGES NEEDED ---
-    This serializer correctly accepts plaintext 'content' from the user.
-    The model's custom .save() method will handle the encryption automatically.
+    This serializer accepts plaintext 'content' from the user.
+    The model's custom .save() method encrypts it and, unless
+    CHAT_STORE_PLAINTEXT is on, never writes the plaintext to the table.
     """
+    # Declared explicitly: the model column is nullable, but a send needs content.
+    content = serializers.CharField()
+
     class Meta:
         model = Message
         fields = ['content']
 
-# --- ChatRoom Serializers (No Changes Needed) ---
+# --- ChatRoom Serializers ---
 
 class ChatRoomListSerializer(serializers.ModelSerializer):
     created_by = serializers.StringRelatedField()
     member_count = serializers.SerializerMethodField()
+    is_member = serializers.SerializerMethodField()
+    unread_count = serializers.SerializerMethodField()
 
     class Meta:
         model = ChatRoom
         fields = [
             'id', 'name', 'slug', 'description', 'is_private',
-            'created_by', 'member_count'
+            'created_by', 'member_count', 'is_member', 'unread_count'
         ]
 
     def get_member_count(self, obj):
+        # Prefer the value annotated by ChatRoom.objects.with_member_info().
+        if hasattr(obj, 'member_count'):
+            return obj.member_count
         return obj.members.count()
 
+    def get_is_member(self, obj):
+        if hasattr(obj, 'is_member'):
+            return obj.is_member
+        request = self.context.get('request')
+        return bool(request) and obj.members.filter(pk=request.user.pk).exists()
+
+    def get_unread_count(self, obj):
+        if hasattr(obj, 'unread_count'):
+            return obj.unread_count
+        request = self.context.get('request')
+        cursor = request and obj.read_cursors.filter(user_id=request.user.pk).first()
+        return obj.message_count - cursor.read_count if cursor else 0
+
 
 class ChatRoomDetailSerializer(ChatRoomListSerializer):
     members = UserSerializer(many=True, read_only=True)
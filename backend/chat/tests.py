@@ -1,3 +1,215 @@
-from django.test import TestCase
+import importlib.util
+import unittest
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from authentication.models import User
+
+from . import membership, receipts, recent, throttling
+from .archive import History, archive_room
+from .models import ArchivedMessage, ChatRoom, Message, ReadCursor
+
+
+def make_user(name):
+    return User.objects.create_user(
+        username=name, email=f'{name}@example.com', password='pw', first_name=name, last_name='Test',
+    )
+
+
+class ChatTestCase(TestCase):
+    def setUp(self):
+        # Process-wide caches outlive each test's transaction.
+        membership._cache.clear()
+        patcher = mock.patch.object(recent, 'messages', recent.RecentMessages())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.room = ChatRoom.objects.create(name='General', slug='general', created_by=self.alice)
+        self.room.members.add(self.alice, self.bob)
+
+    def send(self, count, days_ago=None, user=None):
+        """Bulk-sends `count` messages, one minute apart, starting `days_ago` days back (default: now)."""
+        start = timezone.now() - timedelta(days=days_ago or 0, minutes=count)
+        return Message.objects.bulk_send([
+            Message(room=self.room, user=user or self.alice, content=f'message {i}',
+                    timestamp=start + timedelta(minutes=i))
+            for i in range(count)
+        ])
+
+
+class TokenBucketsTests(SimpleTestCase):
+    def test_refills_at_rate_up_to_burst(self):
+        buckets = throttling.TokenBuckets(rate=5, burst=20, maxsize=10)
+        self.assertEqual(buckets.wait_time('k', 1, now=0), 0)
+        buckets.take('k', 20, now=0)
+        self.assertAlmostEqual(buckets.wait_time('k', 1, now=0), 0.2)
+        self.assertEqual(buckets.wait_time('k', 1, now=0.2), 0)
+        # A long idle period refills to the burst, never beyond it.
+        self.assertEqual(buckets.wait_time('k', 20, now=100), 0)
+        self.assertAlmostEqual(buckets.wait_time('k', 20, now=2), 2)
+
+    def test_batch_larger_than_burst_goes_into_debt(self):
+        buckets = throttling.TokenBuckets(rate=5, burst=20, maxsize=10)
+        # Only a full bucket is needed, even for a batch larger than the burst.
+        self.assertEqual(buckets.wait_time('k', 50, now=0), 0)
+        buckets.take('k', 50, now=0)
+        # 30 tokens of debt plus the one needed: 31 / 5 seconds.
+        self.assertAlmostEqual(buckets.wait_time('k', 1, now=0), 6.2)
+        self.assertEqual(buckets.wait_time('k', 1, now=6.2), 0)
+
+
+@override_settings(
+    CHAT_SEND_RATE_PER_USER=1, CHAT_SEND_BURST_PER_USER=3,
+    CHAT_SEND_RATE_PER_ROOM=1, CHAT_SEND_BURST_PER_ROOM=5,
+)
+class SendRateLimiterTests(SimpleTestCase):
+    def make_limiter(self):
+        limiter = throttling.SendRateLimiter()
+        limiter._take = None
+        return limiter
+
+    def test_local_buckets_limit_user_then_room(self):
+        limiter = self.make_limiter()
+        self.assertEqual([limiter.check(1, 1) for _ in range(3)], [0, 0, 0])
+        self.assertGreater(limiter.check(1, 1), 0)
+        self.assertEqual([limiter.check(2, 1) for _ in range(2)], [0, 0])
+        self.assertGreater(limiter.check(3, 1), 0)
+        stats = limiter.stats()
+        self.assertEqual((stats['allowed'], stats['throttled_user'], stats['throttled_room']), (5, 1, 1))
+
+    @unittest.skipIf(throttling.redis is None, 'redis is not installed')
+    def test_falls_back_to_local_buckets_when_redis_fails(self):
+        limiter = self.make_limiter()
+
+        def unavailable(**kwargs):
+            raise throttling.redis.ConnectionError('down')
+
+        limiter._take = unavailable
+        self.assertEqual([limiter.check(1, 1) for _ in range(3)], [0, 0, 0])
+        self.assertGreater(limiter.check(1, 1), 0)
+
+    @unittest.skipIf(importlib.util.find_spec('fakeredis') is None, 'fakeredis is not installed')
+    def test_shared_buckets_are_shared_between_limiters(self):
+        import fakeredis
+
+        server = fakeredis.FakeServer()
+        first, second = self.make_limiter(), self.make_limiter()
+        for limiter in (first, second):
+            limiter._take = fakeredis.FakeRedis(server=server).register_script(throttling.TAKE_SCRIPT)
+        self.assertEqual([first.check(1, 1), second.check(1, 1), first.check(1, 1)], [0, 0, 0])
+        self.assertGreater(second.check(1, 1), 0)
+        # Debt is shared too: a full bucket accepts a large batch, then waits it off.
+        self.assertEqual(first.check(2, 2, cost=5), 0)
+        self.assertAlmostEqual(second.check(2, 2), 3, delta=0.1)
+        self.assertEqual(len(first.users), 0)
+
+
+class ReadCursorTests(ChatTestCase):
+    def unread(self, user):
+        return ChatRoom.objects.with_member_info(user).get(pk=self.room.pk).unread_count
+
+    def test_read_count_covers_archived_messages(self):
+        old = self.send(10, days_ago=200)
+        new = self.send(5)
+        archive_room(self.room, timezone.now() - timedelta(days=100))
+        self.assertEqual(ArchivedMessage.objects.filter(room=self.room).count(), 10)
+
+        receipts.read_cursors.write({(self.bob.pk, self.room.pk): old[3]})
+        self.assertEqual(ReadCursor.objects.get(user=self.bob, room=self.room).read_count, 4)
+        self.assertEqual(self.unread(self.bob), 11)
+
+        receipts.read_cursors.write({(self.bob.pk, self.room.pk): new[1]})
+        self.assertEqual(ReadCursor.objects.get(user=self.bob, room=self.room).read_count, 12)
+        self.assertEqual(self.unread(self.bob), 3)
+
+    def test_cursor_never_passes_the_newest_message(self):
+        ids = self.send(3)
+        moved = receipts.read_cursors.write({(self.bob.pk, self.room.pk): ids[-1] + 100})
+        self.assertEqual(moved, {self.room.pk: [(self.bob.pk, ids[-1])]})
+        self.assertEqual(self.unread(self.bob), 0)
+
+    def test_sending_marks_the_senders_messages_read(self):
+        self.send(4, user=self.bob)
+        self.assertEqual(self.unread(self.bob), 0)
+        self.assertEqual(self.unread(self.alice), 4)
+
+
+class HistoryTests(ChatTestCase):
+    def test_slices_across_the_archive_boundary(self):
+        self.send(18, days_ago=200)
+        self.send(12)
+        history = History.for_room(self.room).order_by('-timestamp', '-id')
+        slices = [(0, 10), (0, 25), (5, 12), (8, 16), (10, 20), (20, 30), (25, 40)]
+        expected = {s: [m.pk for m in history[s[0]:s[1]]] for s in slices}
+
+        archive_room(self.room, timezone.now() - timedelta(days=100))
+        self.room.refresh_from_db()
+        history = History.for_room(self.room).order_by('-timestamp', '-id')
+        self.assertTrue(history.has_archive)
+        self.assertEqual(history.count(), 30)
+        for start, stop in slices:
+            with self.subTest(start=start, stop=stop):
+                self.assertEqual([m.pk for m in history[start:stop]], expected[start, stop])
+
+    def test_hot_pages_do_not_read_the_archive(self):
+        self.send(10, days_ago=200)
+        self.send(20)
+        archive_room(self.room, timezone.now() - timedelta(days=100))
+        self.room.refresh_from_db()
+        history = History.for_room(self.room).order_by('-timestamp', '-id')
+        with self.assertNumQueries(2):
+            rows = history[5:15]
+        self.assertTrue(all(isinstance(row, Message) for row in rows))
+
+
+class RecentMessagesTests(ChatTestCase):
+    url = '/api/chat/rooms/general/messages/?before='
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+        self.send(3)
+
+    def newest(self):
+        return [message['content'] for message in self.client.get(self.url).data['results']]
+
+    def assertCached(self):
+        self.newest()
+        self.assertIsNotNone(recent.messages.get(self.room.slug))
+
+    def test_send_is_appended(self):
+        self.assertCached()
+        self.client.post('/api/chat/rooms/general/messages/', {'content': 'hello'}, format='json')
+        self.assertEqual(self.newest()[0], 'hello')
+
+    def test_edit_invalidates(self):
+        self.assertCached()
+        message = Message.objects.filter(room=self.room).order_by('-id').first()
+        message.content = 'edited'
+        message.edited = True
+        message.save()
+        self.assertIsNone(recent.messages.get(self.room.slug))
+        self.assertEqual(self.newest()[0], 'edited')
+
+    def test_delete_invalidates(self):
+        self.assertCached()
+        Message.objects.filter(room=self.room).order_by('-id').first().delete()
+        self.assertIsNone(recent.messages.get(self.room.slug))
+        self.assertEqual(self.newest(), ['message 1', 'message 0'])
+
+    def test_bulk_send_invalidates(self):
+        self.assertCached()
+        response = self.client.post(
+            '/api/chat/rooms/general/messages/bulk/', {'messages': [{'content': 'a'}, {'content': 'b'}]},
+            format='json',
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertIsNone(recent.messages.get(self.room.slug))
+        self.assertEqual(self.newest()[:2], ['b', 'a'])
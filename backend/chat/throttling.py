@@ -0,0 +1,189 @@
+"""
+Token-bucket rate limiting for message sends.
+
+Every send, over REST or WebSocket, takes tokens from two buckets: one for
+the sender and one for the room. The sender bucket stops a single bot from
+flooding. The room bucket caps the encryption and write load that any one
+room can cause. A bucket refills at `rate` tokens per second, up to
+`burst`.
+
+A bulk send costs one token per message. A batch larger than the burst is
+still accepted when the bucket is full. The bucket then goes into debt,
+and the sender waits until it has paid the debt back. Bulk senders
+therefore average out to the same rate as everyone else.
+
+When the channel layer is Redis, the buckets live in that Redis, so every
+worker shares them. Both buckets are checked and taken in one Lua script,
+which keeps concurrent sends from different workers from overdrawing them.
+With the in-memory channel layer, or while Redis cannot be reached, each
+process falls back to buckets in its own memory. The limits are then
+enforced per process.
+"""
+import logging
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+
+from chatbot.cache import BoundedCache
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+# KEYS: the user's and the room's bucket.
+# ARGV: cost, then rate and burst for each bucket.
+# Returns each bucket's wait in seconds, as strings since Lua numbers are truncated to integers on return.
+# Nothing is taken unless both waits are 0.
+TAKE_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local cost = tonumber(ARGV[1])
+local levels, waits = {}, {}
+for i = 1, 2 do
+    local rate, burst = tonumber(ARGV[i * 2]), tonumber(ARGV[i * 2 + 1])
+    local state = redis.call('HMGET', KEYS[i], 'tokens', 'updated')
+    local level = burst
+    if state[1] then
+        level = math.min(burst, tonumber(state[1]) + (now - tonumber(state[2])) * rate)
+    end
+    levels[i] = level
+    waits[i] = math.max(0, (math.min(cost, burst) - level) / rate)
+end
+if waits[1] > 0 or waits[2] > 0 then
+    return {tostring(waits[1]), tostring(waits[2])}
+end
+for i = 1, 2 do
+    local rate, burst = tonumber(ARGV[i * 2]), tonumber(ARGV[i * 2 + 1])
+    local tokens = levels[i] - cost
+    redis.call('HSET', KEYS[i], 'tokens', tostring(tokens), 'updated', tostring(now))
+    -- A bucket is dropped once it has refilled, like the in-process ones.
+    redis.call('PEXPIRE', KEYS[i], math.ceil((burst - tokens) / rate * 1000) + 1)
+end
+return {'0', '0'}
+"""
+
+
+def redis_client():
+    """A client for the Redis behind the channel layer, or None if the layer does not use Redis."""
+    layer = settings.CHANNEL_LAYERS['default']
+    if redis is None or not layer['BACKEND'].startswith('channels_redis.'):
+        return None
+    host = layer.get('CONFIG', {}).get('hosts', [('localhost', 6379)])[0]
+    options = {'socket_timeout': 0.5, 'socket_connect_timeout': 0.5}
+    if isinstance(host, str):
+        return redis.Redis.from_url(host, **options)
+    if isinstance(host, dict):
+        host = dict(host)
+        address = host.pop('address', None)
+        if address:
+            return redis.Redis.from_url(address, **host, **options)
+        return redis.Redis(**host, **options)
+    return redis.Redis(host=host[0], port=host[1], **options)
+
+
+class TokenBuckets:
+    def __init__(self, rate, burst, maxsize):
+        self.rate = rate
+        self.burst = burst
+        # A bucket left alone until it is full again is indistinguishable
+        # from a new one, so entries expire once fully refilled.
+        self._buckets = BoundedCache(maxsize)
+
+    def _level(self, key, now):
+        state = self._buckets.get(key)
+        if state is None:
+            return self.burst
+        tokens, updated = state
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def wait_time(self, key, cost, now):
+        """Seconds until `cost` tokens can be taken from `key`; 0 if they can now."""
+        needed = min(cost, self.burst)
+        missing = needed - self._level(key, now)
+        return max(0.0, missing / self.rate)
+
+    def take(self, key, cost, now):
+        tokens = self._level(key, now) - cost
+        self._buckets.set(key, (tokens, now), ttl=(self.burst - tokens) / self.rate)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class SendRateLimiter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        client = redis_client()
+        self._take = client.register_script(TAKE_SCRIPT) if client is not None else None
+        # Used when there is no Redis, or when it fails.
+        self.users = TokenBuckets(
+            settings.CHAT_SEND_RATE_PER_USER, settings.CHAT_SEND_BURST_PER_USER, settings.CHAT_RATE_LIMIT_MAX_KEYS
+        )
+        self.rooms = TokenBuckets(
+            settings.CHAT_SEND_RATE_PER_ROOM, settings.CHAT_SEND_BURST_PER_ROOM, settings.CHAT_RATE_LIMIT_MAX_KEYS
+        )
+        self._counters = Counter()
+
+    def check(self, user_id, room_id, cost=1):
+        """
+        Takes `cost` tokens from both the user's and the room's bucket.
+        Returns 0 if the send may go ahead. Otherwise nothing is taken and the
+        number of seconds to wait is returned.
+        """
+        if self._take is not None:
+            try:
+                return self._check_shared(user_id, room_id, cost)
+            except redis.RedisError as e:
+                logger.error(f"Shared rate limit check failed, using this process's buckets: {e}")
+        return self._check_local(user_id, room_id, cost)
+
+    def _check_shared(self, user_id, room_id, cost):
+        user_wait, room_wait = (float(wait) for wait in self._take(
+            keys=[f'chat:send:user:{user_id}', f'chat:send:room:{room_id}'],
+            args=[cost, self.users.rate, self.users.burst, self.rooms.rate, self.rooms.burst],
+        ))
+        return self._count(cost, user_wait, room_wait)
+
+    def _count(self, cost, user_wait, room_wait):
+        with self._lock:
+            if user_wait or room_wait:
+                self._counters['throttled_user' if user_wait >= room_wait else 'throttled_room'] += 1
+                return max(user_wait, room_wait)
+            self._counters['allowed'] += 1
+            self._counters['allowed_messages'] += cost
+            return 0
+
+    def _check_local(self, user_id, room_id, cost):
+        now = time.monotonic()
+        with self._lock:
+            user_wait = self.users.wait_time(user_id, cost, now)
+            room_wait = self.rooms.wait_time(room_id, cost, now)
+            if not (user_wait or room_wait):
+                self.users.take(user_id, cost, now)
+                self.rooms.take(room_id, cost, now)
+        return self._count(cost, user_wait, room_wait)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'allowed': self._counters['allowed'],
+                'allowed_messages': self._counters['allowed_messages'],
+                'throttled_user': self._counters['throttled_user'],
+                'throttled_room': self._counters['throttled_room'],
+                'shared': self._take is not None,
+                'active_user_buckets': len(self.users),
+                'active_room_buckets': len(self.rooms),
+                'limits': {
+                    'user': {'rate': self.users.rate, 'burst': self.users.burst},
+                    'room': {'rate': self.rooms.rate, 'burst': self.rooms.burst},
+                },
+            }
+
+
+# One limiter per process.
+send_limiter = SendRateLimiter()
@@ -11,6 +11,18 @@ urlpatterns = [
     # GET, POST -> /api/chat/rooms/
     path('rooms/', views.RoomListCreateView.as_view(), name='room-list-create'),
 
+    # Online members of one or more rooms
+    # GET -> /api/chat/presence/?rooms=<slug>,<slug>
+    path('presence/', views.PresenceView.as_view(), name='presence'),
+
+    # Message send rate limiter counters (staff only)
+    # GET -> /api/chat/rate-limits/
+    path('rate-limits/', views.RateLimitStatsView.as_view(), name='rate-limit-stats'),
+
+    # Decryption and recent-message cache counters (staff only)
+    # GET -> /api/chat/cache-stats/
+    path('cache-stats/', views.CacheStatsView.as_view(), name='cache-stats'),
+
     # Retrieve details for a single room
     # GET -> /api/chat/rooms/<slug>/
     path('rooms/<slug:slug>/', views.RoomDetailView.as_view(), name='room-detail'),
@@ -19,10 +31,34 @@ urlpatterns = [
     # GET, POST -> /api/chat/rooms/<slug>/messages/
     path('rooms/<slug:slug>/messages/', views.MessageListCreateView.as_view(), name='message-list-create'),
 
+    # Send many messages at once (bridges, bots, imports)
+    # POST -> /api/chat/rooms/<slug>/messages/bulk/
+    path('rooms/<slug:slug>/messages/bulk/', views.MessageBulkCreateView.as_view(), name='message-bulk-create'),
+
+    # Keyword search over a room's messages
+    # GET -> /api/chat/rooms/<slug>/messages/search/?q=<words>
+    path('rooms/<slug:slug>/messages/search/', views.MessageSearchView.as_view(), name='message-search'),
+
+    # Fetch messages newer than the client's last-seen message id
+    # GET -> /api/chat/rooms/<slug>/messages/since/<message_id>/
+    path('rooms/<slug:slug>/messages/since/<int:message_id>/', views.MessageSyncView.as_view(), name='message-sync'),
+
+    # How far each member has read; mark the room read
+    # GET, POST -> /api/chat/rooms/<slug>/read/
+    path('rooms/<slug:slug>/read/', views.ReadCursorView.as_view(), name='room-read-cursors'),
+
+    # Download a room's full history as NDJSON (creator or staff)
+    # GET -> /api/chat/rooms/<slug>/export/
+    path('rooms/<slug:slug>/export/', views.RoomExportView.as_view(), name='room-export'),
+
     # Action to join a room
     # POST -> /api/chat/rooms/<slug>/join/
     path('rooms/<slug:slug>/join/', views.JoinRoomView.as_view(), name='room-join'),
 
+    # Action to add several users to a room (room creator only)
+    # POST -> /api/chat/rooms/<slug>/members/
+    path('rooms/<slug:slug>/members/', views.AddMembersView.as_view(), name='room-add-members'),
+
     # Action to leave a room
     # POST -> /api/chat/rooms/<slug>/leave/
     path('rooms/<slug:slug>/leave/', views.LeaveRoomView.as_view(), name='room-leave'),
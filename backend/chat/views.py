@@ -1,12 +1,27 @@
+import base64
+import binascii
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.shortcuts import get_object_or_404
 from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.utils.text import slugify
 from rest_framework import generics, status, pagination
+from rest_framework.exceptions import NotFound, Throttled
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
-from .models import ChatRoom, Message
+from . import blind_index, encryption, membership, monitoring, presence, receipts, recent
+from .archive import History
+from .export import export_response
+from .throttling import send_limiter
+from .fanout import broadcast_event, broadcast_events
+from .models import ChatRoom, Message, MessageSearchToken, RoomFullError
 from .serializers import (
     ChatRoomListSerializer,
     ChatRoomDetailSerializer,
@@ -15,12 +30,137 @@ from .serializers import (
     MessageCreateSerializer,
 )
 
+User = get_user_model()
+
+
 class StandardResultsSetPagination(pagination.PageNumberPagination):
     """Custom pagination class for consistent API responses."""
     page_size = 25
     page_size_query_param = 'page_size'
     max_page_size = 100
 
+
+class MessageHistoryPagination(StandardResultsSetPagination):
+    """
+    Pagination for room message history.
+
+    Without cursor parameters it behaves exactly like StandardResultsSetPagination.
+    Passing ``before`` or ``after`` switches to keyset mode: pages are seeked on
+    the (timestamp, id) index instead of using OFFSET, and no COUNT(*) is run, so
+    every page costs the same no matter how deep into the history it is.
+
+    - ``?before=`` (empty) returns the newest page.
+    - ``?before=<cursor>`` returns messages older than the cursor.
+    - ``?after=<cursor>`` returns messages newer than the cursor.
+
+    Results are always newest first, like the page-number mode.
+    """
+    before_query_param = 'before'
+    after_query_param = 'after'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        params = request.query_params
+        self.keyset = self.before_query_param in params or self.after_query_param in params
+        if not self.keyset:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        page_size = self.get_page_size(request)
+
+        if self.after_query_param in params:
+            timestamp, pk = self.decode_cursor(params[self.after_query_param])
+            rows = list(
+                queryset.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk))
+                .order_by('timestamp', 'id')[:page_size + 1]
+            )
+            self.has_newer = len(rows) > page_size
+            self.has_older = True
+            rows = rows[:page_size]
+            rows.reverse()
+        else:
+            cursor = params[self.before_query_param]
+            if cursor:
+                timestamp, pk = self.decode_cursor(cursor)
+                queryset = queryset.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk))
+            rows = list(queryset.order_by('-timestamp', '-id')[:page_size + 1])
+            self.has_older = len(rows) > page_size
+            self.has_newer = bool(cursor)
+            rows = rows[:page_size]
+
+        self.rows = rows
+        return rows
+
+    def is_first_page(self, request):
+        """Whether the request asks for the newest page, in either mode."""
+        params = request.query_params
+        if self.after_query_param in params:
+            return False
+        if self.before_query_param in params:
+            return not params[self.before_query_param]
+        return params.get(self.page_query_param) in (None, '', '1')
+
+    def get_cached_response(self, request, buffer):
+        """
+        The newest page built from a chat.recent buffer instead of a queryset,
+        in the same shape as the mode the request asked for.
+        """
+        page_size = self.get_page_size(request)
+        self.rows = buffer.newest(page_size)
+        data = [row.data for row in self.rows]
+        self.keyset = self.before_query_param in request.query_params
+        if not self.keyset:
+            more = buffer.count > page_size
+            return Response({
+                'count': buffer.count,
+                'next': replace_query_param(request.build_absolute_uri(), self.page_query_param, 2) if more else None,
+                'previous': None,
+                'results': data,
+            })
+
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.has_older = buffer.has_older(page_size)
+        self.has_newer = False
+        return self.get_paginated_response(data)
+
+    def encode_cursor(self, message):
+        raw = f'{message.timestamp.isoformat()}|{message.pk}'
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+            timestamp, pk = raw.rsplit('|', 1)
+            parsed = parse_datetime(timestamp)
+            if parsed is None:
+                raise ValueError(timestamp)
+            return parsed, int(pk)
+        except (TypeError, ValueError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_keyset_link(self, param, message):
+        url = remove_query_param(self.base_url, self.before_query_param)
+        url = remove_query_param(url, self.after_query_param)
+        url = remove_query_param(url, self.page_query_param)
+        return replace_query_param(url, param, self.encode_cursor(message))
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super().get_paginated_response(data)
+
+        older = newer = None
+        if self.rows and self.has_older:
+            older = self.get_keyset_link(self.before_query_param, self.rows[-1])
+        if self.rows and self.has_newer:
+            newer = self.get_keyset_link(self.after_query_param, self.rows[0])
+        return Response({
+            'next': older,
+            'previous': newer,
+            'results': data,
+        })
+
 # --- Room Views ---
 
 class RoomListCreateView(generics.ListCreateAPIView):
@@ -33,10 +173,9 @@ class RoomListCreateView(generics.ListCreateAPIView):
     pagination_class = StandardResultsSetPagination
 
     def get_queryset(self):
-        # Filter rooms to show public ones and private ones the user belongs to
-        return ChatRoom.objects.filter(
-            Q(is_private=False) | Q(members=self.request.user)
-        ).distinct()
+        # Public rooms and private ones the user belongs to, with member_count and
+        # is_member annotated in the same query.
+        return ChatRoom.objects.visible_to(self.request.user).select_related('created_by')
 
     def get_serializer_class(self):
         # Use different serializers for listing (GET) and creating (POST)
@@ -65,48 +204,306 @@ class RoomDetailView(generics.RetrieveAPIView):
     """
     permission_classes = [IsAuthenticated]
     serializer_class = ChatRoomDetailSerializer
-    queryset = ChatRoom.objects.all()
     lookup_field = 'slug'
 
+    def get_queryset(self):
+        return ChatRoom.objects.with_member_info(self.request.user).select_related('created_by')
+
     def get_object(self):
         # Add a permission check for private rooms
         room = super().get_object()
-        user = self.request.user
-        if room.is_private and user not in room.members.all():
+        # is_member is annotated by with_member_info(), so this costs no extra query.
+        if room.is_private and not room.is_member:
             self.permission_denied(self.request, message="You do not have permission to access this private room.")
         return room
 
 # --- Message Views ---
 
-class MessageListCreateView(generics.ListCreateAPIView):
+class RoomMemberMixin:
+    """Shared room lookup for views that require room membership."""
+
+    def get_room(self):
+        """Helper method to get the room and check user membership."""
+        slug = self.kwargs['slug']
+        room = get_object_or_404(ChatRoom, slug=slug)
+        if not membership.is_member(room.pk, self.request.user.pk):
+            self.permission_denied(self.request, message="You must be a member of the room to view or send messages.")
+        return room
+
+
+def check_send_rate(user, room, cost=1):
+    """Raises Throttled (429 with Retry-After) if the user or room is over its send rate."""
+    wait = send_limiter.check(user.pk, room.pk, cost)
+    if wait:
+        raise Throttled(wait=wait)
+
+
+class MessageListCreateView(RoomMemberMixin, generics.ListCreateAPIView):
     """
     API Endpoint for Messages in a Room:
-    - GET: Lists all messages within a specific room.
+    - GET: Lists all messages within a specific room, archived ones included.
     - POST: Creates (sends) a new message to the room.
+    Supports page-number and keyset (``before``/``after`` cursor) pagination.
     """
     permission_classes = [IsAuthenticated]
-    pagination_class = StandardResultsSetPagination
+    pagination_class = MessageHistoryPagination
 
     def get_serializer_class(self):
         if self.request.method == 'POST':
             return MessageCreateSerializer
         return MessageSerializer
 
-    def get_room(self):
-        """Helper method to get the room and check user membership."""
+    def get_queryset(self, room=None):
+        room = room or self.get_room()
+        return History.for_room(room).select_related('user').order_by('-timestamp', '-id')
+
+    def list(self, request, *args, **kwargs):
+        # The newest page is served from the room's recent-message buffer: no
+        # queries once the buffer and the membership check are cached.
+        paginator = self.paginator
+        if not paginator.is_first_page(request) or paginator.get_page_size(request) > recent.messages.size:
+            return super().list(request, *args, **kwargs)
+
         slug = self.kwargs['slug']
-        room = get_object_or_404(ChatRoom, slug=slug)
-        if self.request.user not in room.members.all():
-            self.permission_denied(self.request, message="You must be a member of the room to view or send messages.")
-        return room
+        # Keyset pages never need the room's total, so only page-number mode counts it.
+        page_number_mode = paginator.before_query_param not in request.query_params
+        buffer = recent.messages.get(slug)
+        room = None
+        if buffer is None:
+            room = self.get_room()
+            version = recent.messages.version()
+            history = self.get_queryset(room)
+            # One extra row tells whether older messages exist.
+            newest = history[:recent.messages.size + 1]
+            truncated = len(newest) > recent.messages.size
+            newest = newest[:recent.messages.size]
+            data = self.get_serializer(newest, many=True).data
+            count = history.count() if page_number_mode else None
+            buffer = recent.messages.fill(slug, room.pk, zip(newest, data), truncated, count, version)
+        elif not membership.is_member(buffer.room_id, request.user.pk):
+            self.permission_denied(request, message="You must be a member of the room to view or send messages.")
+        if page_number_mode and buffer.count is None:
+            recent.messages.set_count(buffer, self.get_queryset(room or self.get_room()).count())
+        return paginator.get_cached_response(request, buffer)
 
-    def get_queryset(self):
+    def perform_create(self, serializer):
         room = self.get_room()
-        return Message.objects.filter(room=room).order_by('-timestamp')
+        check_send_rate(self.request.user, room)
+        message = serializer.save(user=self.request.user, room=room)
+        # Push the new message to members connected over WebSocket.
+        message._decrypted_content = message.content
+        data = dict(MessageSerializer(message).data)
+        broadcast_event(room.pk, {'type': 'message', 'message': data})
+        recent.messages.append(room.slug, message, data)
+        monitoring.feed.record_sync(room.pk, message.pk, message.ciphertext)
 
-    def perform_create(self, serializer):
+
+class MessageBulkCreateView(RoomMemberMixin, APIView):
+    """
+    API Endpoint for bridges, bots and imports:
+    - POST: Sends up to CHAT_BULK_SEND_MAX_MESSAGES messages to the room in one request.
+      Body: {"messages": [{"content": "..."}, ...]}. Returns the new ids in order.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, slug, format=None):
+        room = self.get_room()
+        payload = request.data.get('messages')
+        if not isinstance(payload, list) or not payload:
+            return Response({'error': 'messages must be a non-empty list.'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(payload) > settings.CHAT_BULK_SEND_MAX_MESSAGES:
+            return Response(
+                {'error': f'At most {settings.CHAT_BULK_SEND_MAX_MESSAGES} messages can be sent at once.'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        serializer = MessageCreateSerializer(data=payload, many=True)
+        serializer.is_valid(raise_exception=True)
+        check_send_rate(request.user, room, cost=len(payload))
+        messages = [
+            Message(room=room, user=request.user, content=item['content'])
+            for item in serializer.validated_data
+        ]
+        ids = Message.objects.bulk_send(messages)
+        recent.messages.invalidate(room.slug)
+        # Open sockets get the whole batch as one frame.
+        for message in messages:
+            message._decrypted_content = message.content
+        broadcast_events(room.pk, [
+            {'type': 'message', 'message': data} for data in MessageSerializer(messages, many=True).data
+        ])
+        return Response({'ids': ids}, status=status.HTTP_201_CREATED)
+
+
+class MessageSyncView(RoomMemberMixin, generics.GenericAPIView):
+    """
+    API Endpoint for catching up after a reconnect:
+    - GET: Lists messages newer than the client's last-seen message id, oldest first.
+    At most CHAT_SYNC_MAX_MESSAGES are returned per call (``?limit=`` can lower it);
+    ``more`` tells the client to call again from the returned ``last_id``.
+
+    Ids come from a sequence and can commit out of order, so a message with a
+    lower id may appear after a higher one was read. ``last_id`` therefore stops
+    before the first message from the last CHAT_SYNC_OVERLAP_SECONDS seconds,
+    and the next call returns those messages again. Clients should skip ids
+    they already have. Only a page made up entirely of such messages moves
+    ``last_id`` past them, so that syncing always makes progress.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = MessageSerializer
+
+    def get_limit(self):
+        max_limit = settings.CHAT_SYNC_MAX_MESSAGES
+        try:
+            limit = int(self.request.query_params.get('limit', max_limit))
+        except ValueError:
+            return max_limit
+        return min(max(limit, 1), max_limit)
+
+    def get(self, request, slug, message_id, format=None):
         room = self.get_room()
-        serializer.save(user=self.request.user, room=room)
+        limit = self.get_limit()
+        messages = History.for_room(room).filter(id__gt=message_id).select_related('user').order_by('id')[:limit + 1]
+        more = len(messages) > limit
+        messages = messages[:limit]
+        settled_before = timezone.now() - timedelta(seconds=settings.CHAT_SYNC_OVERLAP_SECONDS)
+        last_id = message_id
+        for message in messages:
+            if message.timestamp > settled_before:
+                break
+            last_id = message.id
+        if more and last_id == message_id:
+            last_id = messages[-1].id
+        serializer = self.get_serializer(messages, many=True)
+        return Response({
+            'results': serializer.data,
+            'more': more,
+            'last_id': last_id,
+        })
+
+
+class ReadCursorView(RoomMemberMixin, APIView):
+    """
+    API Endpoint for read receipts in a room:
+    - GET: Returns how far each member has read, as ``{user_id: last_read_message_id}``.
+    - POST: Marks the room read up to ``{"message_id": <id>}``.
+    WebSocket clients should send ``{"type": "read"}`` events instead; those are
+    buffered and written in bulk, while a POST is written immediately.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, slug, format=None):
+        room = self.get_room()
+        return Response(receipts.read_cursors.cursors_in_room(room.pk))
+
+    def post(self, request, slug, format=None):
+        room = self.get_room()
+        message_id = request.data.get('message_id')
+        if type(message_id) is not int or message_id < 1:
+            return Response({'error': 'message_id must be a positive integer.'}, status=status.HTTP_400_BAD_REQUEST)
+        if message_id > receipts.newest_message_ids([room.pk])[room.pk]:
+            return Response({'error': 'message_id is not a message in this room.'}, status=status.HTTP_400_BAD_REQUEST)
+        receipts.read_cursors.mark_read_now(request.user.pk, room.pk, message_id)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class MessageSearchView(RoomMemberMixin, generics.GenericAPIView):
+    """
+    API Endpoint for keyword search in a room:
+    - GET: ``?q=<words>`` lists the room's messages containing every word, newest
+      first, at most CHAT_SEARCH_MAX_RESULTS per call (``?limit=`` can lower it).
+      Pass the returned ``next`` as ``?before=`` for older matches.
+    Matches come from the blind index; only the returned page is decrypted.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = MessageSerializer
+
+    def get(self, request, slug, format=None):
+        room = self.get_room()
+        if not blind_index.is_enabled():
+            return Response({'error': 'Search is not configured.'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        query = request.query_params.get('q', '')
+        if not blind_index.words(query):
+            return Response({'error': 'q must contain at least one word.'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            before = int(request.query_params['before']) if 'before' in request.query_params else None
+            limit = int(request.query_params.get('limit', settings.CHAT_SEARCH_MAX_RESULTS))
+        except ValueError:
+            return Response({'error': 'before and limit must be integers.'}, status=status.HTTP_400_BAD_REQUEST)
+        limit = min(max(limit, 1), settings.CHAT_SEARCH_MAX_RESULTS)
+
+        message_ids = MessageSearchToken.matching(room, query, before=before, limit=limit)
+        candidates = History.for_room(room).filter(id__in=message_ids).select_related('user').order_by('-id')[:limit]
+        Message.prefetch_decrypted(candidates)
+        results = [m for m in candidates if blind_index.matches_query(query, m.decrypted_content)]
+        return Response({
+            'results': self.get_serializer(results, many=True).data,
+            'next': message_ids[-1] if len(message_ids) == limit else None,
+        })
+
+
+class RoomExportView(APIView):
+    """
+    API Endpoint for moving a room between deployments:
+    - GET: Streams the room's full history as NDJSON (see chat.export), for
+      the room creator or staff. Load it elsewhere with ``manage.py import_room``.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, slug, format=None):
+        room = get_object_or_404(ChatRoom, slug=slug)
+        if room.created_by_id != request.user.pk and not request.user.is_staff:
+            self.permission_denied(request, message="Only the room creator can export its history.")
+        return export_response(request._request, room)
+
+
+class PresenceView(APIView):
+    """
+    API Endpoint for online members:
+    - GET: ``?rooms=<slug>,<slug>`` returns the ids of online members for each
+      requested room the user can see, answered with one query for all rooms.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, format=None):
+        slugs = [slug for slug in request.query_params.get('rooms', '').split(',') if slug]
+        if not slugs:
+            return Response({'error': 'rooms is required.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        rooms = dict(
+            ChatRoom.objects.visible_to(request.user)
+            .filter(slug__in=slugs)
+            .values_list('pk', 'slug')
+        )
+        online = presence.tracker.online_in_rooms(list(rooms))
+        return Response({rooms[room_id]: sorted(user_ids) for room_id, user_ids in online.items()})
+
+
+class RateLimitStatsView(APIView):
+    """
+    API Endpoint for operators:
+    - GET: Message send rate limiter counters for this process (staff only).
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, format=None):
+        return Response(send_limiter.stats())
+
+
+class CacheStatsView(APIView):
+    """
+    API Endpoint for operators:
+    - GET: Hit/miss counters and sizes of this process's decryption and
+      recent-message caches (staff only).
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, format=None):
+        return Response({
+            'decryption': encryption.cache_stats(),
+            'recent_messages': recent.messages.stats(),
+        })
 
 
 # --- Action Views ---
@@ -124,17 +521,51 @@ class JoinRoomView(APIView):
 
         if room.is_private:
             return Response({'error': 'Cannot join a private room directly.'}, status=status.HTTP_403_FORBIDDEN)
-        
-        if room.members.count() >= room.max_members:
-            return Response({'error': 'This room is full.'}, status=status.HTTP_409_CONFLICT)
-        
-        if user in room.members.all():
+
+        if membership.is_member(room.pk, user.pk):
             return Response({'message': 'You are already a member of this room.'}, status=status.HTTP_200_OK)
 
-        room.members.add(user)
+        # Capacity check and insert happen under a row lock on the room.
+        try:
+            added = room.add_members([user.pk])
+        except RoomFullError:
+            return Response({'error': 'This room is full.'}, status=status.HTTP_409_CONFLICT)
+
+        if not added:
+            return Response({'message': 'You are already a member of this room.'}, status=status.HTTP_200_OK)
         return Response({'message': f'Successfully joined room "{room.name}".'}, status=status.HTTP_200_OK)
 
 
+class AddMembersView(APIView):
+    """
+    API Endpoint for adding several users to a Room at once:
+    - POST: Adds the users in ``user_ids`` to the room. Only the room creator may do this,
+      which is also how members get into private rooms.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, slug, format=None):
+        room = get_object_or_404(ChatRoom, slug=slug)
+        if room.created_by_id != request.user.pk:
+            return Response({'error': 'Only the room creator can add members.'}, status=status.HTTP_403_FORBIDDEN)
+
+        user_ids = request.data.get('user_ids')
+        if not isinstance(user_ids, list) or not all(isinstance(pk, int) for pk in user_ids):
+            return Response({'error': 'user_ids must be a list of user ids.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        known_ids = set(User.objects.filter(pk__in=user_ids).values_list('pk', flat=True))
+        unknown_ids = set(user_ids) - known_ids
+        if unknown_ids:
+            return Response({'error': f'Unknown user ids: {sorted(unknown_ids)}'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            added = room.add_members(known_ids)
+        except RoomFullError:
+            return Response({'error': 'Not enough space in this room for all of these users.'}, status=status.HTTP_409_CONFLICT)
+
+        return Response({'added': sorted(added)}, status=status.HTTP_200_OK)
+
+
 class LeaveRoomView(APIView):
     """
     API Endpoint for a User to Leave a Room:
@@ -146,7 +577,7 @@ class LeaveRoomView(APIView):
         room = get_object_or_404(ChatRoom, slug=slug)
         user = request.user
 
-        if user not in room.members.all():
+        if not membership.is_member(room.pk, user.pk):
             return Response({'error': 'You are not a member of this room.'}, status=status.HTTP_400_BAD_REQUEST)
         
         room.members.remove(user)
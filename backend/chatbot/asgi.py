@@ -10,14 +10,25 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 import os
 
 from django.core.asgi import get_asgi_application
-from channels.routing import ProtocolTypeRouter
 
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chatbot.settings")
+# Initialise Django before importing anything that touches models.
 django_asgi_app = get_asgi_application()
 
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chatbot.settings")
+from channels.auth import AuthMiddlewareStack  # noqa: E402
+from channels.routing import ProtocolTypeRouter, URLRouter  # noqa: E402
+from channels.security.websocket import AllowedHostsOriginValidator  # noqa: E402
+
+from authentication.middleware import OAuth2TokenAuthMiddleware  # noqa: E402
+from chat.routing import websocket_urlpatterns  # noqa: E402
+
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
-    # Just HTTP for now. (We can add other protocols later.)
+    "websocket": AllowedHostsOriginValidator(
+        AuthMiddlewareStack(
+            OAuth2TokenAuthMiddleware(URLRouter(websocket_urlpatterns))
+        )
+    ),
 })
 
 ASGI_APPLICATION = 'ChatApp.asgi.application'
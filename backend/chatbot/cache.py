@@ -0,0 +1,91 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class BoundedCache:
+    """
+    Thread-safe, process-local LRU cache with an optional per-entry TTL.
+
+    Used for small hot lookups (membership checks and the like) where a short
+    staleness window is acceptable and a round trip to the database is not.
+    Each process keeps its own copy; callers must invalidate locally on writes
+    and rely on the TTL for changes made by other processes.
+
+    With `maxbytes`, entries are also evicted once the sum of sizeof(value)
+    over all entries passes that many bytes. `maxsize` can then be None to
+    bound the cache by memory alone.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, maxbytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof or sys.getsizeof
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at, size = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                self._bytes -= size
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        size = self.sizeof(value) if self.maxbytes is not None else 0
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[2]
+            self._data[key] = (value, expires_at, size)
+            self._bytes += size
+            while self._data and (
+                (self.maxsize is not None and len(self._data) > self.maxsize)
+                or (self.maxbytes is not None and self._bytes > self.maxbytes)
+            ):
+                _, (_, _, evicted_size) = self._data.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'bytes': self._bytes,
+                'maxbytes': self.maxbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
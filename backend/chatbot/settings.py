@@ -13,9 +13,17 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 from pathlib import Path
 import os
 
+from dotenv import load_dotenv
+
+from authentication.conf import AuthClientConfig
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# Secrets (FERNET_KEY, OAuth2 client credentials, ...) usually live in backend/.env.
+# It is read once here; real environment variables take precedence.
+load_dotenv(BASE_DIR / '.env')
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
@@ -57,7 +65,7 @@ MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
-    'oauth2_provider.middleware.OAuth2TokenMiddleware',
+    'authentication.authentication.CachedOAuth2TokenMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -147,14 +155,100 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
 # Channels Configuration
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
-        'CONFIG': {
-            "hosts": [('127.0.0.1', 6379)],
-        },
+# CHANNEL_LAYER=memory switches to the in-process layer, so WebSocket tests and the
+# fanout_benchmark command run without Redis. It only works within a single process.
+if os.environ.get('CHANNEL_LAYER', 'redis') == 'memory':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        }
     }
-}
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                "hosts": [('127.0.0.1', 6379)],
+            },
+        }
+    }
+
+# WebSocket fan-out: once a room has broadcast within CHAT_FANOUT_WINDOW seconds,
+# further events are coalesced into one frame per window (at most CHAT_FANOUT_MAX_BATCH events).
+CHAT_FANOUT_WINDOW = 0.05
+CHAT_FANOUT_MAX_BATCH = 50
+
+# Monitoring feed (ws/monitoring/): fraction of messages mirrored as individual events,
+# how often per-room throughput is published, and per-dashboard buffering.
+CHAT_MONITORING_SAMPLE_RATE = float(os.environ.get('CHAT_MONITORING_SAMPLE_RATE', 0.1))
+CHAT_MONITORING_STATS_INTERVAL = 5  # seconds
+CHAT_MONITORING_QUEUE_SIZE = 200  # events buffered per dashboard before the oldest are dropped
+CHAT_MONITORING_FLUSH_INTERVAL = 0.25  # seconds between frames sent to a dashboard
+
+# Presence: users without a heartbeat for CHAT_PRESENCE_TTL seconds go offline;
+# changes are written to UserActivity in bulk every CHAT_PRESENCE_FLUSH_INTERVAL seconds.
+CHAT_PRESENCE_TTL = 60
+CHAT_PRESENCE_FLUSH_INTERVAL = 15
+
+# Typing indicators are forwarded at most once per CHAT_TYPING_DEBOUNCE seconds per user and room;
+# read cursors are written in bulk and broadcast every CHAT_READ_RECEIPT_FLUSH_INTERVAL seconds.
+CHAT_TYPING_DEBOUNCE = 3
+CHAT_READ_RECEIPT_FLUSH_INTERVAL = 2
+
+# Message send rate limits (token buckets, shared through the channel layer's Redis): tokens
+# refill at RATE per second up to BURST. Each message costs one token from the sender's and the room's bucket.
+CHAT_SEND_RATE_PER_USER = 5
+CHAT_SEND_BURST_PER_USER = 20
+CHAT_SEND_RATE_PER_ROOM = 50
+CHAT_SEND_BURST_PER_ROOM = 200
+CHAT_RATE_LIMIT_MAX_KEYS = 100_000  # in-process buckets (no Redis) kept before the least recently used are dropped
+
+# Message search: words are stored as HMACs keyed with CHAT_SEARCH_KEY (see chat.blind_index).
+# Leave it unset to disable indexing and search. Changing it requires `index_messages --rebuild`.
+CHAT_SEARCH_KEY = os.environ.get('CHAT_SEARCH_KEY')
+CHAT_SEARCH_MAX_RESULTS = 50
+
+# Room exports read and decrypt this many messages at a time.
+CHAT_EXPORT_CHUNK_SIZE = 2000
+
+# Messages older than this many days move to the archive table when archive_messages runs.
+# ChatRoom.archive_after_days overrides it per room; None keeps everything in the hot table.
+CHAT_ARCHIVE_AFTER_DAYS = 90
+
+# Chat message decryption
+# Pages with at least CHAT_DECRYPT_PARALLEL_THRESHOLD messages still to decrypt (cache misses)
+# are decrypted on a thread pool of CHAT_DECRYPT_MAX_WORKERS threads; bulk sends encrypt the
+# same way. Keep it at or below the history page cap (max_page_size, 100) or pages never use the pool.
+# Set workers to 0 to always decrypt inline.
+CHAT_DECRYPT_MAX_WORKERS = int(os.environ.get('CHAT_DECRYPT_MAX_WORKERS', 0))
+CHAT_DECRYPT_PARALLEL_THRESHOLD = int(os.environ.get('CHAT_DECRYPT_PARALLEL_THRESHOLD', 64))
+# Per-process cache of decrypted message text, capped at CHAT_DECRYPT_CACHE_BYTES
+# (0 disables it). Entries optionally expire after CHAT_DECRYPT_CACHE_TTL seconds.
+CHAT_DECRYPT_CACHE_BYTES = int(os.environ.get('CHAT_DECRYPT_CACHE_BYTES', 64 * 1024 * 1024))
+CHAT_DECRYPT_CACHE_TTL = None
+
+# Persist Message.content next to its ciphertext. Off by default: plaintext is
+# encrypted on save and never written to the table.
+CHAT_STORE_PLAINTEXT = os.environ.get('CHAT_STORE_PLAINTEXT', 'false').lower() == 'true'
+
+# Largest batch accepted by the bulk send endpoint (messages/bulk/)
+CHAT_BULK_SEND_MAX_MESSAGES = 1000
+
+# Hard cap on messages returned by one delta-sync (messages/since/<id>/) call
+CHAT_SYNC_MAX_MESSAGES = 200
+# Message ids can commit out of order, so delta sync re-reads messages from the last
+# CHAT_SYNC_OVERLAP_SECONDS seconds on the next call (clients skip ids they already have).
+CHAT_SYNC_OVERLAP_SECONDS = 5
+
+# Per-process cache of each room's newest messages, serialized, for opening a room
+# without queries. Messages sent through other processes appear once the TTL expires.
+CHAT_RECENT_MESSAGES_SIZE = 50  # messages per room; pages larger than this skip the cache
+CHAT_RECENT_MESSAGES_ROOMS = 1_000  # rooms kept before the least recently used are dropped
+CHAT_RECENT_MESSAGES_TTL = 10  # seconds
+
+# Per-process cache of (room_id, user_id) membership checks
+CHAT_MEMBERSHIP_CACHE_TTL = 5  # seconds
+CHAT_MEMBERSHIP_CACHE_SIZE = 50_000
 
 # OAuth2 Configuration
 OAUTH2_PROVIDER = {
@@ -164,6 +258,15 @@ OAUTH2_PROVIDER = {
     }
 }
 
+# OAuth2 client used by the login, refresh and logout views (ID, SECRET, BASE_URL).
+# Loaded once at startup; call authentication.conf.reload() to pick up changes.
+AUTH_CLIENT = AuthClientConfig.from_env()
+
+# Per-process cache of validated access tokens (see authentication.authentication).
+# A token revoked through another process can keep working here for up to the TTL.
+AUTH_TOKEN_CACHE_TTL = 60  # seconds
+AUTH_TOKEN_CACHE_SIZE = 10_000
+
 # Social Auth Configuration (for OAuth2)
 # AUTHENTICATION_BACKENDS = (
 #     'social_core.backends.google.GoogleOAuth2',
@@ -187,7 +290,7 @@ AUTH_USER_MODEL = 'authentication.User'
 # REST Framework Configuration
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'oauth2_provider.contrib.rest_framework.OAuth2Authentication',
+        'authentication.authentication.CachedOAuth2Authentication',
          
     ], 
     'DEFAULT_PERMISSION_CLASSES': [